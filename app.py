@@ -1,12 +1,30 @@
 from flask import Flask, request, jsonify, send_from_directory, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from model import parse_player_csv, final_over_probability
+from model import parse_player_csv, final_over_probability, final_over_probabilities
 import requests
 import pandas as pd
 import numpy as np
 import os
+import sys
 import re
+import logging
+import hashlib
 import time
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Log delle richieste: formattazione lazy, saltata del tutto sotto LOG_LEVEL (es. WARNING in produzione)
+logger = logging.getLogger("nba_over")
+# LOG_LEVEL sconosciuto (es. "verbose"): INFO con un avviso, non un ValueError che blocca il worker
+_LOG_LEVEL = getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), None)
+logger.setLevel(_LOG_LEVEL if isinstance(_LOG_LEVEL, int) else logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+logger.propagate = False
+if not isinstance(_LOG_LEVEL, int):
+    logger.warning("⚠️  LOG_LEVEL=%s non valido, uso INFO", os.environ.get("LOG_LEVEL"))
 
 # Payments (Stripe + PayPal)
 try:
@@ -24,7 +42,51 @@ try:
 except ImportError:
     NBA_API_AVAILABLE = False
 
+# Sessione HTTP condivisa verso stats.nba.com: connessioni keep-alive riusate tra le richieste
+if NBA_API_AVAILABLE:
+    try:
+        from nba_api.stats.library.http import NBAStatsHTTP
+        from requests.adapters import HTTPAdapter
+        _NBA_SESSION = requests.Session()
+        _NBA_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+        NBAStatsHTTP.set_session(_NBA_SESSION)
+    except (ImportError, AttributeError) as e:
+        print(f"⚠️  Sessione condivisa nba_api non configurata: {e}")
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from whitenoise import WhiteNoise
+    WHITENOISE_AVAILABLE = True
+except ImportError:
+    WHITENOISE_AVAILABLE = False
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider basato su orjson: request.get_json() e jsonify passano da qui"""
+    OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if ORJSON_AVAILABLE else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson produce già bytes: niente encode/decode intermedio
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.OPTIONS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+# Tetto ai body: i CSV di una stagione sono pochi KB, oltre rispondiamo 413 senza bufferizzare
+app.config["MAX_CONTENT_LENGTH"] = 4 * 1024 * 1024
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
 CORS(app)
 
 # Registra blueprint pagamenti
@@ -53,20 +115,68 @@ else:
 # CACHE GIOCATORI NBA (caricata una volta all'avvio)
 # ============================================
 
-_ALL_NBA_PLAYERS = []  # cache globale
+_ALL_NBA_PLAYERS = None  # cache globale (None = non ancora caricata)
+_PLAYERS_RETRY_AT = 0.0  # dopo un errore non si ritenta prima di questo istante
+_PLAYERS_RETRY_DELAY = 60
+_PLAYERS_LOCK = threading.RLock()  # thread di preload e prima richiesta non caricano due volte
 
 def get_all_players():
     """Carica e cachea tutti i giocatori NBA da nba_api"""
-    global _ALL_NBA_PLAYERS
-    if _ALL_NBA_PLAYERS:
+    global _ALL_NBA_PLAYERS, _PLAYERS_RETRY_AT
+    if _ALL_NBA_PLAYERS is not None:
         return _ALL_NBA_PLAYERS
-    try:
-        if NBA_API_AVAILABLE:
-            _ALL_NBA_PLAYERS = nba_players_static.get_players()
-            print(f"✅ Caricati {len(_ALL_NBA_PLAYERS)} giocatori da nba_api")
-    except Exception as e:
-        print(f"⚠️  Errore caricamento giocatori: {e}")
-    return _ALL_NBA_PLAYERS
+    if time.time() < _PLAYERS_RETRY_AT:
+        return []
+    with _PLAYERS_LOCK:
+        if _ALL_NBA_PLAYERS is None and time.time() >= _PLAYERS_RETRY_AT:
+            try:
+                if NBA_API_AVAILABLE:
+                    players = nba_players_static.get_players()
+                    if players:
+                        _ALL_NBA_PLAYERS = players
+                        print(f"✅ Caricati {len(_ALL_NBA_PLAYERS)} giocatori da nba_api")
+            except Exception as e:
+                print(f"⚠️  Errore caricamento giocatori: {e}")
+            if _ALL_NBA_PLAYERS is None:
+                # Niente retry a ogni tasto dell'autocomplete
+                _PLAYERS_RETRY_AT = time.time() + _PLAYERS_RETRY_DELAY
+    return _ALL_NBA_PLAYERS or []
+
+
+_ACTIVE_PLAYER_INDEX = []  # [(nome_lower, nome, player_id)] ordinato per nome
+_ACTIVE_NAME_GRAMS = {}    # {bigramma/trigramma: set(posizioni in _ACTIVE_PLAYER_INDEX)}
+
+
+def _name_grams(text, n):
+    """Tutti gli n-grammi (sottostringhe di lunghezza n) di text"""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def get_active_player_index():
+    """Indice dei giocatori attivi con nome già in minuscolo, ordinato per nome"""
+    global _ACTIVE_PLAYER_INDEX
+    if _ACTIVE_PLAYER_INDEX:
+        return _ACTIVE_PLAYER_INDEX
+    with _PLAYERS_LOCK:
+        if not _ACTIVE_PLAYER_INDEX:
+            active = [p for p in get_all_players() if p.get("is_active", False)]
+            index = [
+                (p.get("full_name", "").lower(), p.get("full_name", ""), p["id"])
+                for p in sorted(active, key=lambda p: p.get("full_name", ""))
+            ]
+            # Indice invertito n-grammi → posizioni: la ricerca scansiona solo i candidati
+            grams = {}
+            for pos, (name_lower, _, _) in enumerate(index):
+                for n in (2, 3):
+                    for g in _name_grams(name_lower, n):
+                        grams.setdefault(g, set()).add(pos)
+            _ACTIVE_NAME_GRAMS.clear()
+            _ACTIVE_NAME_GRAMS.update(grams)
+            _ACTIVE_PLAYER_INDEX = index
+    return _ACTIVE_PLAYER_INDEX
+
+# Precarica giocatori e indice in background: la prima ricerca non paga il caricamento
+threading.Thread(target=get_active_player_index, daemon=True).start()
 
 # ============================================
 # CONFIGURAZIONE FRONTEND FIREBASE
@@ -74,6 +184,27 @@ def get_all_players():
 
 FRONTEND_PATH = os.path.join(os.path.dirname(__file__), 'frontend', 'firebase')
 
+
+def static_headers(headers, path, url):
+    """HTML e service worker sempre rivalidati; il SW deve poter controllare tutta l'origine"""
+    if url.endswith(".html") or url == "/":
+        headers["Cache-Control"] = "no-cache"
+    elif url == "/service-worker.js":
+        headers["Cache-Control"] = "no-cache"
+        headers["Service-Worker-Allowed"] = "/"
+
+
+# File statici serviti da WhiteNoise prima di arrivare a Flask (file indicizzati
+# una volta all'avvio, ETag/304 e varianti .gz/.br precompresse se presenti).
+# Le route send_from_directory sotto restano come fallback senza WhiteNoise.
+if WHITENOISE_AVAILABLE:
+    app.wsgi_app = WhiteNoise(
+        app.wsgi_app,
+        root=FRONTEND_PATH,
+        index_file=True,
+        add_headers_function=static_headers,
+    )
+
 print("=" * 70)
 print("🏀 NBA OVER PREDICTOR - FIREBASE VERSION")
 print("=" * 70)
@@ -159,9 +290,8 @@ def serve_index():
     return send_from_directory(FRONTEND_PATH, 'index.html')
 
 
-@app.route("/firebase-config.js")
-def serve_firebase_config():
-    """Genera firebase-config.js dinamicamente dalle variabili d'ambiente"""
+def build_firebase_config_js() -> bytes:
+    """Genera firebase-config.js dalle variabili d'ambiente (costanti per tutto il processo)"""
     config = {
         "apiKey":            os.environ.get("FIREBASE_API_KEY", ""),
         "authDomain":        os.environ.get("FIREBASE_AUTH_DOMAIN", ""),
@@ -187,9 +317,20 @@ if (typeof firebase !== "undefined" && !firebase.apps.length) {{
   console.log("✅ Firebase initialized");
 }}
 """
-    response = Response(js_content, mimetype='application/javascript')
-    response.headers['Cache-Control'] = 'no-store'
-    return response
+    return js_content.encode("utf-8")
+
+
+FIREBASE_CONFIG_JS   = build_firebase_config_js()
+FIREBASE_CONFIG_ETAG = hashlib.sha1(FIREBASE_CONFIG_JS).hexdigest()
+
+
+@app.route("/firebase-config.js")
+def serve_firebase_config():
+    """Serve firebase-config.js pre-generato all'avvio, con ETag per le risposte 304"""
+    response = Response(FIREBASE_CONFIG_JS, mimetype='application/javascript')
+    response.set_etag(FIREBASE_CONFIG_ETAG)
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    return response.make_conditional(request)
 
 
 @app.route("/logo.png")
@@ -250,30 +391,215 @@ def search_players():
     if not query or len(query) < 2:
         return jsonify({"results": []}), 200
 
-    all_players = get_all_players()
+    index = get_active_player_index()
 
-    results = []
-    for p in all_players:
-        # Solo giocatori attivi
-        if not p.get("is_active", False):
-            continue
-        full_name = p.get("full_name", "")
-        if query in full_name.lower():
-            results.append({
-                "name":      full_name,
-                "player_id": p["id"],
-                "is_active": True
-            })
-
-    # Priorità: nome inizia con query, poi alfabetico
-    results.sort(key=lambda x: (
-        not x["name"].lower().startswith(query),
-        x["name"]
-    ))
+    # Candidati: intersezione delle posting list dei trigrammi (bigrammi se query di 2 caratteri)
+    postings = [_ACTIVE_NAME_GRAMS.get(g, set()) for g in _name_grams(query, 3 if len(query) >= 3 else 2)]
+    candidates = sorted(set.intersection(*postings)) if postings else []
+
+    # Priorità: nome inizia con query, poi alfabetico (l'indice è già ordinato)
+    prefix_hits, other_hits = [], []
+    for pos in candidates:
+        name_lower, full_name, player_id = index[pos]
+        if name_lower.startswith(query):
+            prefix_hits.append({"name": full_name, "player_id": player_id, "is_active": True})
+            if len(prefix_hits) == 10:
+                break
+        elif len(other_hits) < 10 and query in name_lower:
+            other_hits.append({"name": full_name, "player_id": player_id, "is_active": True})
+    results = prefix_hits + other_hits
 
     return jsonify({"results": results[:10]}), 200
 
 
+# ============================================
+# CACHE GAME LOG (player_id, stagione) → CSV
+# ============================================
+
+_PLAYER_CSV_CACHE = OrderedDict()  # {(player_id, season_str): (timestamp, csv_text, games_count)}
+_PLAYER_CSV_CACHE_MAX = 512
+_PLAYER_CSV_TTL = 3600  # il game log cambia al massimo una volta per giornata NBA
+_PLAYER_CSV_STALE_TTL = 6 * 3600  # oltre il TTL: servita subito e rinnovata in background
+_PLAYER_CSV_LOCK = threading.Lock()
+_PLAYER_CSV_REFRESHING = set()  # chiavi con un refresh in background già in corso
+
+# Pool condiviso per i fetch in parallelo: max_workers limita le richieste simultanee a stats.nba.com
+_NBA_FETCH_POOL = ThreadPoolExecutor(max_workers=6, thread_name_prefix="nba-fetch")
+_BATCH_MAX_PLAYERS = 15
+
+_FETCH_JOBS = OrderedDict()  # {job_id: (timestamp, future, player_name, season_str)}
+_FETCH_JOBS_TTL = 600        # i risultati restano consultabili per 10 minuti
+_FETCH_JOBS_MAX = 1024       # oltre, escono i job più vecchi anche se non scaduti
+_FETCH_JOBS_MAX_PENDING = 32 # job async non ancora finiti: oltre → 429
+_FETCH_JOBS_INFLIGHT = {}    # {(player_id, season_str): job_id} dei job in corso, riusati da richieste uguali
+_FETCH_JOBS_LOCK = threading.Lock()
+# Pool separato e piccolo per i job async: non toglie worker ai fetch sincroni e ai refresh SWR
+_ASYNC_FETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="nba-fetch-async")
+
+
+class NBAApiError(Exception):
+    """Errore nel recupero del game log, con lo status HTTP da restituire"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def build_player_csv(player_id: int, season_str: str, player_name: str = "Unknown"):
+    """Scarica il game log da nba_api e lo converte nel CSV formato Basketball Reference"""
+    # Scarica game log con retry automatico (NBA API è instabile)
+    df = None
+    last_error = None
+    for attempt in range(3):
+        try:
+            if attempt > 0:
+                time.sleep(2 * attempt)  # 2s, 4s tra i retry
+                logger.info("[nba_api] retry %s/2 per player_id=%s", attempt, player_id)
+            log = playergamelog.PlayerGameLog(
+                player_id=player_id,
+                season=season_str,
+                timeout=15 + (attempt * 10)  # 15s, 25s, 35s
+            )
+            df = log.get_data_frames()[0]
+            break  # successo, esci dal loop
+        except Exception as e:
+            last_error = e
+            logger.warning("[nba_api] tentativo %s fallito: %s", attempt + 1, e)
+            continue
+
+    if df is None:
+        raise NBAApiError(f"NBA API non raggiungibile dopo 3 tentativi. Usa il CSV manuale. ({str(last_error)[:80]})", 503)
+
+    if df.empty:
+        raise NBAApiError(f"Nessuna partita trovata per {player_name} nella stagione {season_str}", 404)
+
+    # ── Rinomina colonne → formato Basketball Reference ────────────────
+    df = df.rename(columns={
+        "GAME_DATE":   "Date",
+        "FGM":         "FG",
+        "FG_PCT":      "FG%",
+        "FG3M":        "3P",
+        "FG3A":        "3PA",
+        "FG3_PCT":     "3P%",
+        "FTM":         "FT",
+        "FT_PCT":      "FT%",
+        "OREB":        "ORB",
+        "DREB":        "DRB",
+        "REB":         "TRB",
+        "PLUS_MINUS":  "+/-",
+        "MIN":         "MP",
+    })
+
+    # ── Colonne numeriche ──────────────────────────────────────────────
+    num_cols = ["FG", "FGA", "FG%", "3P", "3PA", "3P%",
+                "FT", "FTA", "FT%", "ORB", "DRB", "TRB",
+                "AST", "STL", "BLK", "TOV", "PF", "PTS", "+/-"]
+    for col in num_cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+
+    # ── Colonne derivate (eFG%, GmSc, 2P, 2PA, 2P%) ───────────────────
+    # Calcolate su ndarray e aggiunte con un solo assign
+    arr = {col: df[col].to_numpy() for col in
+           ("PTS", "FG", "FGA", "3P", "3PA", "FT", "FTA", "ORB", "DRB", "STL", "AST", "BLK", "PF", "TOV")}
+    two_p  = arr["FG"]  - arr["3P"]
+    two_pa = arr["FGA"] - arr["3PA"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        efg     = np.where(arr["FGA"] > 0, (arr["FG"] + 0.5 * arr["3P"]) / arr["FGA"], 0).round(3)
+        two_pct = np.where(two_pa > 0, two_p / two_pa, 0).round(3)
+    gmsc = (
+        arr["PTS"]
+        + 0.4  * arr["FG"]
+        - 0.7  * arr["FGA"]
+        - 0.4  * (arr["FTA"] - arr["FT"])
+        + 0.7  * arr["ORB"]
+        + 0.3  * arr["DRB"]
+        + arr["STL"]
+        + 0.7  * arr["AST"]
+        + 0.7  * arr["BLK"]
+        - 0.4  * arr["PF"]
+        - arr["TOV"]
+    ).round(1)
+    df = df.assign(**{"eFG%": efg, "GmSc": gmsc, "2P": two_p, "2PA": two_pa, "2P%": two_pct})
+
+    # ── Ordine cronologico + colonne finali in un'unica selezione ─────
+    # nba_api restituisce le partite dalla più recente: basta invertire
+    # (GAME_DATE è testo "OCT 25, 2024", ordinarlo come stringa sarebbe sbagliato)
+    final_cols = ["Date", "MP", "FG", "FGA", "FG%",
+                  "3P", "3PA", "3P%", "2P", "2PA", "2P%",
+                  "FT", "FTA", "FT%", "ORB", "DRB", "TRB",
+                  "AST", "STL", "BLK", "TOV", "PF", "PTS",
+                  "GmSc", "+/-", "eFG%"]
+    final_cols = [c for c in final_cols if c in df.columns]
+    df = df.loc[df.index[::-1], final_cols]
+    df.index = pd.RangeIndex(len(df))
+
+    # ── Aggiungi Rk progressivo ────────────────────────────────────────
+    df.insert(0, "Rk", np.arange(1, len(df) + 1))
+
+    # ── Converti in CSV ────────────────────────────────────────────────
+    return df.to_csv(index=False), len(df)
+
+
+def _store_player_csv(key, csv_text, games_count):
+    """Inserisce nella cache LRU (timestamp = adesso)"""
+    with _PLAYER_CSV_LOCK:
+        _PLAYER_CSV_CACHE[key] = (time.time(), csv_text, games_count)
+        _PLAYER_CSV_CACHE.move_to_end(key)
+        while len(_PLAYER_CSV_CACHE) > _PLAYER_CSV_CACHE_MAX:
+            _PLAYER_CSV_CACHE.popitem(last=False)
+
+
+def _refresh_player_csv(key, player_name):
+    """Rinnovo in background di una voce scaduta (stale-while-revalidate)"""
+    try:
+        _store_player_csv(key, *build_player_csv(key[0], key[1], player_name))
+    except Exception as e:
+        logger.warning("⚠️  Refresh game log %s fallito, resta la versione in cache: %s", key, e)
+    finally:
+        with _PLAYER_CSV_LOCK:
+            _PLAYER_CSV_REFRESHING.discard(key)
+
+
+def get_player_csv(player_id: int, season_str: str, player_name: str = "Unknown"):
+    """
+    build_player_csv con cache LRU + TTL: ritorna (csv_text, games_count)
+    
+    Voce fresca → servita dalla cache. Voce scaduta da meno di _PLAYER_CSV_STALE_TTL →
+    servita subito e rinnovata in background. Se nba_api fallisce, qualsiasi versione
+    in cache è meglio di un errore (stale-if-error).
+    """
+    key = (player_id, season_str)
+    now = time.time()
+    with _PLAYER_CSV_LOCK:
+        cached = _PLAYER_CSV_CACHE.get(key)
+        if cached:
+            _PLAYER_CSV_CACHE.move_to_end(key)
+            age = now - cached[0]
+            if age < _PLAYER_CSV_TTL:
+                return cached[1], cached[2]
+            if age < _PLAYER_CSV_STALE_TTL:
+                if key not in _PLAYER_CSV_REFRESHING:
+                    _PLAYER_CSV_REFRESHING.add(key)
+                    _NBA_FETCH_POOL.submit(_refresh_player_csv, key, player_name)
+                return cached[1], cached[2]
+
+    try:
+        csv_text, games_count = build_player_csv(player_id, season_str, player_name)
+    except Exception:
+        if cached:
+            logger.warning("⚠️  nba_api non disponibile, servo il game log in cache per %s", key)
+            return cached[1], cached[2]
+        raise
+
+    _store_player_csv(key, csv_text, games_count)
+    return csv_text, games_count
+
+
+def nba_season_str(season_end: int) -> str:
+    """Formato stagione nba_api: 2025 → 2024-25"""
+    return f"{season_end - 1}-{str(season_end)[-2:]}"
+
+
 @app.route("/fetch_player_csv", methods=["POST"])
 def fetch_player_csv():
     """
@@ -292,106 +618,12 @@ def fetch_player_csv():
     if not player_id:
         return jsonify({"error": "player_id mancante"}), 400
 
-    # Formato stagione nba_api: "2024-25"
-    season_str = f"{season_end - 1}-{str(season_end)[-2:]}"
+    season_str = nba_season_str(season_end)
 
     try:
         player_id = int(player_id)
 
-        # Scarica game log con retry automatico (NBA API è instabile)
-        df = None
-        last_error = None
-        for attempt in range(3):
-            try:
-                if attempt > 0:
-                    time.sleep(2 * attempt)  # 2s, 4s tra i retry
-                    print(f"[nba_api] retry {attempt}/2 per player_id={player_id}")
-                log = playergamelog.PlayerGameLog(
-                    player_id=player_id,
-                    season=season_str,
-                    timeout=15 + (attempt * 10)  # 15s, 25s, 35s
-                )
-                df = log.get_data_frames()[0]
-                break  # successo, esci dal loop
-            except Exception as e:
-                last_error = e
-                print(f"[nba_api] tentativo {attempt+1} fallito: {e}")
-                continue
-
-        if df is None:
-            return jsonify({"error": f"NBA API non raggiungibile dopo 3 tentativi. Usa il CSV manuale. ({str(last_error)[:80]})"}), 503
-
-        if df.empty:
-            return jsonify({"error": f"Nessuna partita trovata per {player_name} nella stagione {season_str}"}), 404
-
-        # ── Rinomina colonne → formato Basketball Reference ────────────────
-        df = df.rename(columns={
-            "GAME_DATE":   "Date",
-            "FGM":         "FG",
-            "FG_PCT":      "FG%",
-            "FG3M":        "3P",
-            "FG3A":        "3PA",
-            "FG3_PCT":     "3P%",
-            "FTM":         "FT",
-            "FT_PCT":      "FT%",
-            "OREB":        "ORB",
-            "DREB":        "DRB",
-            "REB":         "TRB",
-            "PLUS_MINUS":  "+/-",
-            "MIN":         "MP",
-        })
-
-        # ── Colonne numeriche ──────────────────────────────────────────────
-        num_cols = ["FG", "FGA", "FG%", "3P", "3PA", "3P%",
-                    "FT", "FTA", "FT%", "ORB", "DRB", "TRB",
-                    "AST", "STL", "BLK", "TOV", "PF", "PTS", "+/-"]
-        for col in num_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
-
-        # ── Calcola eFG% ───────────────────────────────────────────────────
-        df["eFG%"] = np.where(
-            df["FGA"] > 0,
-            (df["FG"] + 0.5 * df["3P"]) / df["FGA"],
-            0
-        ).round(3)
-
-        # ── Calcola GmSc (Game Score) ──────────────────────────────────────
-        df["GmSc"] = (
-            df["PTS"]
-            + 0.4  * df["FG"]
-            - 0.7  * df["FGA"]
-            - 0.4  * (df["FTA"] - df["FT"])
-            + 0.7  * df["ORB"]
-            + 0.3  * df["DRB"]
-            + df["STL"]
-            + 0.7  * df["AST"]
-            + 0.7  * df["BLK"]
-            - 0.4  * df["PF"]
-            - df["TOV"]
-        ).round(1)
-
-        # ── Calcola 2P, 2PA, 2P% ──────────────────────────────────────────
-        df["2P"]  = df["FG"]  - df["3P"]
-        df["2PA"] = df["FGA"] - df["3PA"]
-        df["2P%"] = np.where(df["2PA"] > 0, df["2P"] / df["2PA"], 0).round(3)
-
-        # ── Aggiungi Rk progressivo ────────────────────────────────────────
-        df = df.iloc[::-1].reset_index(drop=True)  # ordine cronologico
-        df["Rk"] = df.index + 1
-
-        # ── Seleziona e ordina colonne finali ──────────────────────────────
-        final_cols = ["Rk", "Date", "MP", "FG", "FGA", "FG%",
-                      "3P", "3PA", "3P%", "2P", "2PA", "2P%",
-                      "FT", "FTA", "FT%", "ORB", "DRB", "TRB",
-                      "AST", "STL", "BLK", "TOV", "PF", "PTS",
-                      "GmSc", "+/-", "eFG%"]
-        final_cols = [c for c in final_cols if c in df.columns]
-        df = df[final_cols]
-
-        # ── Converti in CSV ────────────────────────────────────────────────
-        csv_text    = df.to_csv(index=False)
-        games_count = len(df)
+        csv_text, games_count = get_player_csv(player_id, season_str, player_name)
 
         return jsonify({
             "success":     True,
@@ -401,9 +633,170 @@ def fetch_player_csv():
             "season":      season_str
         }), 200
 
+    except NBAApiError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": f"Errore nba_api: {str(e)}"}), 500
+
+
+@app.route("/fetch_player_csv/async", methods=["POST"])
+def fetch_player_csv_async():
+    """
+    Come /fetch_player_csv ma non blocca: il download parte in background.
+    Input:  {"player_id": 2544, "player_name": "LeBron James", "season": "2026"}
+    Output: {"job_id": "..."} (202) → poi GET /fetch_player_csv/status/<job_id>
+    """
+    if not NBA_API_AVAILABLE:
+        return jsonify({"error": "nba_api non installato sul server"}), 500
+
+    data        = request.get_json()
+    player_id   = data.get("player_id")
+    player_name = data.get("player_name", "Unknown")
+
+    if not player_id:
+        return jsonify({"error": "player_id mancante"}), 400
+
+    try:
+        player_id  = int(player_id)
+        season_str = nba_season_str(int(data.get("season", "2025")))
+    except (TypeError, ValueError):
+        return jsonify({"error": "player_id o season non validi"}), 400
+
+    key = (player_id, season_str)
+    now = time.time()
+    with _FETCH_JOBS_LOCK:
+        # Job finiti fuori dagli in corso; stesso giocatore e stagione già in corso → stesso job
+        for inflight_key, inflight_id in list(_FETCH_JOBS_INFLIGHT.items()):
+            job = _FETCH_JOBS.get(inflight_id)
+            if job is None or job[1].done():
+                del _FETCH_JOBS_INFLIGHT[inflight_key]
+        job_id = _FETCH_JOBS_INFLIGHT.get(key)
+        if job_id is not None:
+            return jsonify({"success": True, "job_id": job_id}), 202
+        if len(_FETCH_JOBS_INFLIGHT) >= _FETCH_JOBS_MAX_PENDING:
+            return jsonify({"error": "Troppi download in corso, riprova tra poco"}), 429
+
+        job_id = uuid.uuid4().hex
+        future = _ASYNC_FETCH_POOL.submit(get_player_csv, player_id, season_str, player_name)
+        _FETCH_JOBS[job_id] = (now, future, player_name, season_str)
+        _FETCH_JOBS_INFLIGHT[key] = job_id
+        # I job sono in ordine di creazione: scarta quelli scaduti (o in eccesso) in testa
+        while _FETCH_JOBS and (
+            len(_FETCH_JOBS) > _FETCH_JOBS_MAX
+            or now - next(iter(_FETCH_JOBS.values()))[0] > _FETCH_JOBS_TTL
+        ):
+            _FETCH_JOBS.popitem(last=False)
+
+    return jsonify({"success": True, "job_id": job_id}), 202
+
+
+@app.route("/fetch_player_csv/status/<job_id>", methods=["GET"])
+def fetch_player_csv_status(job_id):
+    """
+    Stato di un job di /fetch_player_csv/async
+    Output: {"done": false} oppure {"done": true, "csv": ..., "games": ..., ...} come /fetch_player_csv
+    """
+    with _FETCH_JOBS_LOCK:
+        job = _FETCH_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "job non trovato o scaduto"}), 404
+
+    _, future, player_name, season_str = job
+    if not future.done():
+        return jsonify({"done": False}), 200
+
+    try:
+        csv_text, games_count = future.result()
+    except NBAApiError as e:
+        return jsonify({"done": True, "error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"done": True, "error": f"Errore nba_api: {str(e)}"}), 500
+
+    return jsonify({
+        "done":        True,
+        "success":     True,
+        "csv":         csv_text,
+        "player_name": player_name,
+        "games":       games_count,
+        "season":      season_str
+    }), 200
+
+
+@app.route("/fetch_player_csv_stream", methods=["POST"])
+def fetch_player_csv_stream():
+    """
+    Come /fetch_player_csv, ma restituisce il CSV grezzo (text/csv) invece di
+    incapsularlo in una stringa JSON: niente escape dei newline, niente copia extra.
+    Input:  {"player_id": 2544, "player_name": "LeBron James", "season": "2026"}
+    Output: CSV formato Basketball Reference (header X-Games / X-Season)
+    """
+    if not NBA_API_AVAILABLE:
+        return jsonify({"error": "nba_api non installato sul server"}), 500
+
+    data        = request.get_json()
+    player_id   = data.get("player_id")
+    player_name = data.get("player_name", "Unknown")
+
+    if not player_id:
+        return jsonify({"error": "player_id mancante"}), 400
+
+    try:
+        season_str = nba_season_str(int(data.get("season", "2025")))
+        csv_text, games_count = get_player_csv(int(player_id), season_str, player_name)
+    except NBAApiError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": f"Errore nba_api: {str(e)}"}), 500
 
+    response = Response(csv_text, mimetype='text/csv')
+    response.headers['X-Games']  = str(games_count)
+    response.headers['X-Season'] = season_str
+    return response
+
+
+@app.route("/fetch_players_csv_batch", methods=["POST"])
+def fetch_players_csv_batch():
+    """
+    Scarica i game log di più giocatori in parallelo (le chiamate nba_api si sovrappongono).
+    Input:  {"players": [{"player_id": 2544, "player_name": "LeBron James"}, ...], "season": "2026"}
+    Output: {"success": true, "season": "2025-26", "results": [{"player_id": ..., "csv": ..., "games": ...} | {"player_id": ..., "error": ...}]}
+    """
+    if not NBA_API_AVAILABLE:
+        return jsonify({"error": "nba_api non installato sul server"}), 500
+
+    data        = request.get_json()
+    players_req = data.get("players") or []
+
+    if not isinstance(players_req, list) or not players_req:
+        return jsonify({"error": "players mancante"}), 400
+    if len(players_req) > _BATCH_MAX_PLAYERS:
+        return jsonify({"error": f"Massimo {_BATCH_MAX_PLAYERS} giocatori per richiesta"}), 400
+
+    try:
+        season_str = nba_season_str(int(data.get("season", "2025")))
+    except (TypeError, ValueError):
+        return jsonify({"error": "season non valida"}), 400
+
+    def fetch_one(p):
+        player_id   = p.get("player_id") if isinstance(p, dict) else None
+        player_name = p.get("player_name", "Unknown") if isinstance(p, dict) else "Unknown"
+        if not player_id:
+            return {"player_id": player_id, "error": "player_id mancante"}
+        try:
+            csv_text, games_count = get_player_csv(int(player_id), season_str, player_name)
+            return {"player_id": player_id, "player_name": player_name,
+                    "csv": csv_text, "games": games_count}
+        except Exception as e:
+            return {"player_id": player_id, "player_name": player_name, "error": str(e)}
+
+    results = list(_NBA_FETCH_POOL.map(fetch_one, players_req))
+
+    return jsonify({
+        "success": True,
+        "season":  season_str,
+        "results": results
+    }), 200
+
 
 @app.route("/predict", methods=["POST"])
 def predict():
@@ -429,8 +822,11 @@ def predict():
         result = final_over_probability(df, point_line=point_line, recent_games=35)
         prob_over = result["probability"] / 100
 
-        last_10_points = df.tail(10)["PTS"].tolist()
-        last_10_dates  = df.tail(10)["Date"].dt.strftime('%m/%d').tolist()
+        # Una sola estrazione di PTS: statistiche calcolate direttamente su NumPy
+        pts         = df["PTS"].to_numpy(dtype=np.float64)
+        pts_last_10 = pts[-10:]
+        last_10_points = pts_last_10.tolist()
+        last_10_dates  = df["Date"].iloc[-10:].dt.strftime('%m/%d').tolist()
 
         return jsonify({
             "success": True,
@@ -443,11 +839,11 @@ def predict():
             "total_games": len(df),
             "adjusted": result.get("adjusted", False),
             "player_stats": {
-                "avg_points_last_10": round(df.tail(10)["PTS"].mean(), 2),
-                "avg_points_season":  round(df["PTS"].mean(), 2),
-                "max_points": int(df["PTS"].max()),
-                "min_points": int(df["PTS"].min()),
-                "std_points": round(df["PTS"].std(), 2)
+                "avg_points_last_10": round(float(np.nanmean(pts_last_10)), 2),
+                "avg_points_season":  round(float(np.nanmean(pts)), 2),
+                "max_points": int(np.nanmax(pts)),
+                "min_points": int(np.nanmin(pts)),
+                "std_points": round(float(np.nanstd(pts, ddof=1)), 2)
             },
             "trend": {
                 "points": last_10_points,
@@ -474,21 +870,44 @@ def predict_multiple():
 
     try:
         df = parse_player_csv(csv_text)
-        results = []
+        results = [None] * len(thresholds)
 
-        for threshold in thresholds:
+        # Soglie validate prima del batch: una non numerica (o NaN/inf) non deve far fallire le altre
+        valid = []
+        for i, threshold in enumerate(thresholds):
             try:
-                threshold = float(threshold)
-                result = final_over_probability(df, point_line=threshold, recent_games=35)
-                prob_over = result["probability"] / 100
-                results.append({
-                    "threshold":  threshold,
-                    "probability": round(prob_over * 100, 2),
-                    "confidence": result.get("confidence", "unknown"),
-                    "adjusted":   result.get("adjusted", False)
-                })
-            except Exception:
-                results.append({"threshold": threshold, "error": "Calcolo fallito"})
+                value = float(threshold)
+            except (TypeError, ValueError):
+                value = None
+            if value is None or not np.isfinite(value):
+                results[i] = {"threshold": threshold, "error": "Calcolo fallito"}
+                continue
+            valid.append((i, value))
+
+        # Soglie valide calcolate in batch (campione e quantili condivisi)
+        try:
+            batch = final_over_probabilities(df, [t for _, t in valid], recent_games=35)
+        except Exception as e:
+            # Batch fallito: una soglia alla volta, così ognuna riporta il proprio errore
+            logger.warning("⚠️  Batch soglie fallito, calcolo per singola soglia: %s", e)
+            batch = []
+            for _, threshold in valid:
+                try:
+                    batch.append(final_over_probability(df, point_line=threshold, recent_games=35))
+                except Exception:
+                    batch.append(None)
+
+        for (i, threshold), result in zip(valid, batch):
+            if result is None:
+                results[i] = {"threshold": threshold, "error": "Calcolo fallito"}
+                continue
+            prob_over = result["probability"] / 100
+            results[i] = {
+                "threshold":  threshold,
+                "probability": round(prob_over * 100, 2),
+                "confidence": result.get("confidence", "unknown"),
+                "adjusted":   result.get("adjusted", False)
+            }
 
         return jsonify({
             "success": True,
@@ -500,6 +919,43 @@ def predict_multiple():
         return jsonify({"error": f"Errore: {str(e)}"}), 500
 
 
+# Frazione di Kelly applicata in base alla confidence del modello
+CONFIDENCE_MULTIPLIERS = {
+    "very_low": 0.0,
+    "low":      0.25,
+    "medium":   0.40,
+    "high":     0.50
+}
+
+
+def kelly_batch(bankroll, total_events, probs, odds, confidence_mults):
+    """
+    Stessa matematica di /calculate_bet, vettorizzata su NumPy
+    probs, odds e confidence_mults sono array 1-D; gli altri argomenti scalari.
+    Ritorna un dict di array (kelly_fraction, adjusted_kelly, stake, ...).
+    """
+    b = odds - 1
+    q = 1 - probs
+    kelly_fraction = (b * probs - q) / b
+    adjusted_kelly = kelly_fraction * confidence_mults
+
+    stake = np.minimum(bankroll / total_events, bankroll * adjusted_kelly)
+    stake = np.clip(stake, bankroll * 0.01, bankroll * 0.15)
+
+    potential_profit      = stake * b
+    expected_wins         = total_events * probs
+    expected_total_profit = expected_wins * potential_profit - (total_events - expected_wins) * stake
+
+    return {
+        "kelly_fraction":        kelly_fraction,
+        "adjusted_kelly":        adjusted_kelly,
+        "stake":                 stake,
+        "potential_profit":      potential_profit,
+        "expected_wins":         expected_wins,
+        "expected_total_profit": expected_total_profit,
+    }
+
+
 @app.route("/calculate_bet", methods=["POST"])
 def calculate_bet():
     """
@@ -523,13 +979,7 @@ def calculate_bet():
         q = 1 - p
         kelly_fraction = (b * p - q) / b
 
-        confidence_multipliers = {
-            "very_low": 0.0,
-            "low":      0.25,
-            "medium":   0.40,
-            "high":     0.50
-        }
-        confidence_mult = confidence_multipliers.get(confidence, 0.40)
+        confidence_mult = CONFIDENCE_MULTIPLIERS.get(confidence, 0.40)
         adjusted_kelly  = kelly_fraction * confidence_mult
 
         base_stake_per_event = bankroll / total_events
@@ -593,6 +1043,69 @@ def calculate_bet():
         return jsonify({"error": f"Errore: {str(e)}"}), 500
 
 
+@app.route("/calculate_bet_batch", methods=["POST"])
+def calculate_bet_batch():
+    """
+    Kelly Criterion su più bet in un colpo solo (es. screening di una schedina)
+    Input:  {"bankroll": 100, "target_profit": 80, "total_events": 8,
+             "probabilities": [0.65, 0.58], "odds": [1.90, 2.10],
+             "confidences": ["high", "medium"]}
+    Output: {"stake": [...], "kelly_fraction": [...], "recommended": [...], ...}
+    """
+    data = request.get_json()
+
+    try:
+        bankroll      = float(data["bankroll"])
+        target_profit = float(data["target_profit"])
+        total_events  = int(data["total_events"])
+        probs         = np.asarray(data["probabilities"], dtype=float)
+        odds          = np.asarray(data["odds"], dtype=float)
+        confidences   = data.get("confidences") or ["medium"] * len(probs)
+
+        if probs.ndim != 1 or probs.shape != odds.shape or len(confidences) != len(probs):
+            return jsonify({"error": "probabilities, odds e confidences devono avere la stessa lunghezza"}), 400
+        if total_events <= 0 or np.any(odds <= 1):
+            return jsonify({"error": "total_events deve essere > 0 e odds > 1"}), 400
+
+        conf_mults = np.array([CONFIDENCE_MULTIPLIERS.get(c, 0.40) for c in confidences])
+        very_low   = np.array([c == "very_low" for c in confidences], dtype=bool)
+        high       = np.array([c == "high" for c in confidences], dtype=bool)
+
+        k = kelly_batch(bankroll, total_events, probs, odds, conf_mults)
+        kelly_fraction        = k["kelly_fraction"]
+        expected_total_profit = k["expected_total_profit"]
+
+        # Stesse regole di /calculate_bet, valutate in ordine di priorità
+        rejections = [
+            kelly_fraction <= 0,
+            very_low,
+            probs < 0.55,
+            expected_total_profit < target_profit * 0.7,
+        ]
+        recommended = ~np.logical_or.reduce(rejections)
+        risk_level  = np.select(
+            rejections,
+            ["extreme", "extreme", "high", "medium"],
+            default=np.where(high & (probs > 0.65), "low", "medium")
+        )
+
+        return jsonify({
+            "recommended":           recommended.tolist(),
+            "stake":                 np.round(k["stake"], 2).tolist(),
+            "potential_profit":      np.round(k["potential_profit"], 2).tolist(),
+            "kelly_fraction":        np.round(kelly_fraction, 4).tolist(),
+            "kelly_percentage":      np.round(k["adjusted_kelly"] * 100, 2).tolist(),
+            "risk_level":            risk_level.tolist(),
+            "expected_total_profit": np.round(expected_total_profit, 2).tolist(),
+            "expected_wins":         np.round(k["expected_wins"], 2).tolist(),
+            "break_even_probability": np.round(1 / odds, 4).tolist(),
+            "target_profit":         target_profit,
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": f"Errore: {str(e)}"}), 500
+
+
 @app.route("/guida-csv.html")
 def serve_guida_csv():
     return send_from_directory(FRONTEND_PATH, 'guida-csv.html')
@@ -645,3 +1158,5 @@ if __name__ == "__main__":
     print("=" * 70)
     print("\n")
 
+    # Solo sviluppo locale: in produzione parte gunicorn (Procfile / railway.json)
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=False, threaded=True)
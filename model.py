@@ -1,153 +1,263 @@
 import pandas as pd
 import numpy as np
-from io import StringIO
+import re
+import hashlib
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from io import StringIO, BytesIO
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier, VotingClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier, VotingClassifier
 from sklearn.calibration import CalibratedClassifierCV
+from sklearn.pipeline import Pipeline
+from sklearn.isotonic import isotonic_regression
 import warnings
 warnings.filterwarnings('ignore')
 
 try:
-    from xgboost import XGBClassifier
-    XGBOOST_AVAILABLE = True
+    import xxhash
+    XXHASH_AVAILABLE = True
 except ImportError:
-    XGBOOST_AVAILABLE = False
+    XXHASH_AVAILABLE = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """Senza numba i kernel restano normali funzioni NumPy"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fn: fn
+
+
+# =========================
+# KERNEL NUMERICI
+# =========================
+# Input read-only: con il copy-on-write di pandas 3 to_numpy() su una colonna float64 è una vista
+# non scrivibile (accettano comunque anche array scrivibili e slice)
+_PTS_ARRAY = "Array(float64, 1, 'A', readonly=True)"
+
+
+@njit(f"float64({_PTS_ARRAY}, float64)", cache=True)
+def _over_rate_kernel(pts, line):
+    """% di partite con punti > line (NaN contano come UNDER, come in pandas .gt().mean())"""
+    if pts.size == 0:
+        return np.nan
+    return 100.0 * np.sum(pts > line) / pts.size
+
+
+@njit(f"float64({_PTS_ARRAY}, float64, float64, float64)", cache=True)
+def _weighted_over_kernel(pts, line, w_lo, w_hi):
+    """% OVER pesata con pesi lineari w_lo→w_hi (come np.average con np.linspace)"""
+    n = pts.size
+    if n == 0:
+        return np.nan
+    s = 0.0
+    wsum = 0.0
+    for i in range(n):
+        w = w_lo + (w_hi - w_lo) * i / (n - 1) if n > 1 else w_lo
+        if pts[i] > line:
+            s += w
+        wsum += w
+    return 100.0 * s / wsum
+
+
+@njit(f"int64[:]({_PTS_ARRAY}, float64)", cache=True)
+def _streak_kernel(pts, line):
+    """Serie OVER (+n) / UNDER (-n) consecutive; le partite NaN valgono 0 senza azzerare la serie"""
+    streaks = np.empty(pts.size, dtype=np.int64)
+    current_streak = 0
+    for i in range(pts.size):
+        val = pts[i]
+        if np.isnan(val):
+            streaks[i] = 0
+        elif val > line:
+            current_streak = current_streak + 1 if current_streak >= 0 else 1
+            streaks[i] = current_streak
+        else:
+            current_streak = current_streak - 1 if current_streak <= 0 else -1
+            streaks[i] = current_streak
+    return streaks
 
 
 # =========================
 # CACHE GLOBALE PER MONOTONICITÀ
 # =========================
-_probability_cache = {}  # {player_hash: {threshold: probability}}
+_probability_cache = OrderedDict()  # {player_hash: ({threshold: probability}, [soglie ordinate])}, LRU
+_PROBABILITY_CACHE_MAX = 10_000
+_PROBABILITY_CACHE_LOCK = threading.Lock()
+
+
+def _hash_bytes(data: bytes) -> int:
+    """Hash a 64 bit di un buffer: xxh3 se disponibile, altrimenti blake2b"""
+    if XXHASH_AVAILABLE:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
 
 
-def get_player_hash(df: pd.DataFrame) -> str:
-    """Crea un hash univoco per il giocatore basato sui dati recenti"""
-    recent_pts = df.tail(35)['PTS'].values
-    return hash(tuple(recent_pts))
+def get_player_hash(df: pd.DataFrame) -> int:
+    """Crea un hash univoco per il giocatore basato sui dati recenti (byte grezzi dei punti)"""
+    recent_pts = np.ascontiguousarray(df["PTS"].tail(35).to_numpy(dtype=np.float64))
+    return _hash_bytes(recent_pts.tobytes())
 
 
-def enforce_monotonicity(threshold: float, raw_probability: float, df: pd.DataFrame) -> dict:
+def enforce_monotonicity(threshold: float, raw_probability: float, df: pd.DataFrame, player_hash: int = None) -> dict:
     """
     Post-processing che garantisce monotonicità
     
-    Regola: se prob(soglia_alta) > prob(soglia_bassa), correggi
+    Regola: prob(soglia_alta) <= prob(soglia_bassa). Le probabilità raw del
+    giocatore vengono proiettate con isotonic regression decrescente (PAV).
+    
+    player_hash: hash già calcolato dal chiamante, altrimenti da df
     
     Returns:
         dict con probability corretta e metadata
     """
-    player_hash = get_player_hash(df)
-    
-    # Inizializza cache per questo giocatore
-    if player_hash not in _probability_cache:
-        _probability_cache[player_hash] = {}
-    
-    cache = _probability_cache[player_hash]
-    
-    # Salva probabilità raw
-    cache[threshold] = raw_probability
-    
-    # Ottieni soglie ordinate
-    sorted_thresholds = sorted(cache.keys())
-    
-    # Se è la prima soglia, ritorna raw
-    if len(sorted_thresholds) == 1:
-        return {
-            "probability": raw_probability,
-            "adjusted": False,
-            "method": "raw_ml"
-        }
+    return enforce_monotonicity_batch([threshold], [raw_probability], df, player_hash)[0]
+
+
+def enforce_monotonicity_batch(thresholds, raw_probabilities, df: pd.DataFrame, player_hash: int = None) -> list:
+    """
+    Come enforce_monotonicity, ma con un solo fit PAV per tutte le soglie di una richiesta
     
-    # Trova posizione della soglia corrente
-    current_idx = sorted_thresholds.index(threshold)
+    Tutte le raw entrano in cache prima del fit: le probabilità ritornate escono dalla
+    stessa proiezione, quindi sono non crescenti anche all'interno della risposta.
     
-    # Controlla soglia precedente (più bassa)
-    if current_idx > 0:
-        prev_threshold = sorted_thresholds[current_idx - 1]
-        prev_prob = cache[prev_threshold]
+    Returns:
+        lista di dict, uno per soglia, nello stesso ordine di thresholds
+    """
+    if player_hash is None:
+        player_hash = get_player_hash(df)
+    
+    # Inizializza cache per questo giocatore (LRU: il meno recente esce oltre il limite).
+    # Lookup, insort e lettura delle raw sotto lock: i thread gunicorn condividono la cache
+    with _PROBABILITY_CACHE_LOCK:
+        entry = _probability_cache.get(player_hash)
+        if entry is None:
+            entry = _probability_cache[player_hash] = ({}, [])
+            while len(_probability_cache) > _PROBABILITY_CACHE_MAX:
+                _probability_cache.popitem(last=False)
+        else:
+            _probability_cache.move_to_end(player_hash)
         
-        # REGOLA: prob corrente NON può essere > prob precedente
-        if raw_probability > prev_prob:
-            # Correggi: decremento proporzionale alla differenza, non fisso
-            decrement = min(0.5, (raw_probability - prev_prob) * 0.5)
-            adjusted_prob = prev_prob - decrement
-            adjusted_prob = max(0, adjusted_prob)  # Non negativo
-            
-            cache[threshold] = adjusted_prob
-            
-            return {
-                "probability": adjusted_prob,
-                "adjusted": True,
-                "method": "adjusted_down_from_lower",
-                "original_prob": raw_probability,
-                "reference_threshold": prev_threshold,
-                "reference_prob": prev_prob
-            }
-    
-    # Controlla soglia successiva (più alta)
-    if current_idx < len(sorted_thresholds) - 1:
-        next_threshold = sorted_thresholds[current_idx + 1]
-        next_prob = cache[next_threshold]
+        cache, sorted_thresholds = entry
         
-        # REGOLA: prob corrente NON può essere < prob successiva
-        if raw_probability < next_prob:
-            # Correggi: incremento proporzionale alla differenza, non fisso
-            increment = min(0.5, (next_prob - raw_probability) * 0.5)
-            adjusted_prob = next_prob + increment
-            adjusted_prob = min(100, adjusted_prob)  # Max 100%
-            
-            cache[threshold] = adjusted_prob
-            
-            return {
+        # Salva probabilità raw (le soglie restano ordinate: insert binario, niente sorted())
+        for threshold, raw_probability in zip(thresholds, raw_probabilities):
+            if threshold not in cache:
+                insort(sorted_thresholds, threshold)
+            cache[threshold] = raw_probability
+        
+        # Se è l'unica soglia nota, ritorna raw
+        if len(sorted_thresholds) == 1:
+            return [
+                {"probability": raw_probability, "adjusted": False, "method": "raw_ml"}
+                for raw_probability in raw_probabilities
+            ]
+        
+        # Copia delle raw e posizioni delle soglie: il fit gira fuori dal lock
+        raw = np.fromiter((cache[t] for t in sorted_thresholds), dtype=np.float64, count=len(sorted_thresholds))
+        positions = [bisect_left(sorted_thresholds, t) for t in thresholds]
+    
+    # PAV in C su tutte le soglie note: la cache resta raw, il fit è rifatto ogni volta
+    fitted = np.clip(isotonic_regression(raw, increasing=False), 0, 100)
+    
+    results = []
+    for raw_probability, position in zip(raw_probabilities, positions):
+        adjusted_prob = float(fitted[position])
+        if abs(adjusted_prob - raw_probability) < 1e-9:
+            # Nessun aggiustamento necessario
+            results.append({"probability": raw_probability, "adjusted": False, "method": "raw_ml"})
+        else:
+            results.append({
                 "probability": adjusted_prob,
                 "adjusted": True,
-                "method": "adjusted_up_from_higher",
-                "original_prob": raw_probability,
-                "reference_threshold": next_threshold,
-                "reference_prob": next_prob
-            }
-    
-    # Nessun aggiustamento necessario
-    return {
-        "probability": raw_probability,
-        "adjusted": False,
-        "method": "raw_ml"
-    }
+                "method": "isotonic_pav",
+                "original_prob": raw_probability
+            })
+    return results
 
 
 def clear_cache():
     """Pulisce la cache (utile per test)"""
-    global _probability_cache
-    _probability_cache = {}
+    with _PROBABILITY_CACHE_LOCK:
+        _probability_cache.clear()
+    with _MODEL_CACHE_LOCK:
+        _MODEL_CACHE.clear()
 
 
 # =========================
 # 1️⃣ PARSE CSV
 # =========================
+_MP_CLOCK_RE = re.compile(r"^\s*(\d+):(\d+)\s*$")              # "36:24"
+_NUMBER_RE = re.compile(r"^\s*[-+]?(\d+\.?\d*|\.\d+)\s*$")   # "36", "36.4"
+
+
+_PARSED_CSV_CACHE = OrderedDict()  # {(hash, len) del testo CSV: DataFrame}, LRU
+_PARSED_CSV_CACHE_MAX = 256
+_PARSED_CSV_LOCK = threading.Lock()
+
+
 def parse_player_csv(csv_text: str) -> pd.DataFrame:
+    """Parse CSV con cache sul contenuto: lo stesso CSV (predict → predict_multiple) si parsa una volta"""
+    data = csv_text.encode()
+    key = (_hash_bytes(data), len(data))
+    with _PARSED_CSV_LOCK:
+        df = _PARSED_CSV_CACHE.get(key)
+        if df is not None:
+            _PARSED_CSV_CACHE.move_to_end(key)
+            return df.copy(deep=False)
+    
+    df = _parse_player_csv_uncached(csv_text)
+    
+    with _PARSED_CSV_LOCK:
+        _PARSED_CSV_CACHE[key] = df
+        while len(_PARSED_CSV_CACHE) > _PARSED_CSV_CACHE_MAX:
+            _PARSED_CSV_CACHE.popitem(last=False)
+    return df.copy(deep=False)
+
+
+def _parse_player_csv_uncached(csv_text: str) -> pd.DataFrame:
     """Parse CSV con gestione robusta degli errori"""
-    df = pd.read_csv(StringIO(csv_text))
+    df = None
+    if PYARROW_AVAILABLE:
+        # Reader CSV di Arrow (multithread): MP forzato a testo, celle vuote → NaN come read_csv
+        try:
+            table = pa_csv.read_csv(
+                BytesIO(csv_text.encode()),
+                convert_options=pa_csv.ConvertOptions(column_types={"MP": pa.string()}, strings_can_be_null=True),
+            )
+            df = table.to_pandas()
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Righe corte (Inactive/DNP) o tipi misti: Arrow rifiuta, pandas completa con NaN
+            df = None
+    if df is None:
+        df = pd.read_csv(StringIO(csv_text))
     
     # Rimuovi eventuali righe di totali
-    df = df[df['Rk'].notna() & (df['Rk'] != '')]
-    df = df[df['Date'].notna()]
+    # (una sola maschera e un solo filtro: Rk valorizzato e Date presente)
+    df = df[df['Rk'].notna() & (df['Rk'] != '') & df['Date'].notna()]
     
     df["Date"] = pd.to_datetime(df["Date"])
-    df = df.sort_values("Date").reset_index(drop=True)
-    
-    # Parsing minuti giocati
-    def mp_to_minutes(mp):
-        if pd.isna(mp):
-            return np.nan
-        if isinstance(mp, str) and ":" in mp:
-            parts = mp.split(":")
-            return int(parts[0]) + int(parts[1]) / 60
-        try:
-            return float(mp)
-        except:
-            return np.nan
+    df = df.sort_values("Date", ignore_index=True)
     
-    df["MP_min"] = df["MP"].apply(mp_to_minutes)
+    # Parsing minuti giocati (vettoriale): "MM:SS" → minuti decimali, numeri così come sono
+    mp = df["MP"].astype(str)
+    clock = mp.str.extract(_MP_CLOCK_RE)
+    clock_min = pd.to_numeric(clock[0], errors="coerce") + pd.to_numeric(clock[1], errors="coerce") / 60
+    plain_min = pd.to_numeric(mp.where(mp.str.match(_NUMBER_RE)), errors="coerce")
+    df["MP_min"] = clock_min.fillna(plain_min).astype(float)
     
     # Colonne numeriche
     numeric_cols = [
@@ -161,9 +271,11 @@ def parse_player_csv(csv_text: str) -> pd.DataFrame:
         "eFG%"
     ]
     
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
+    # float32: statistiche per partita piccole/a 3 decimali, metà memoria per le feature
+    present = [col for col in numeric_cols if col in df.columns]
+    if present:
+        df[present] = df[present].apply(pd.to_numeric, errors="coerce").astype(np.float32)
+    df["MP_min"] = df["MP_min"].astype(np.float32)
     
     return df
 
@@ -171,83 +283,83 @@ def parse_player_csv(csv_text: str) -> pd.DataFrame:
 # =========================
 # 2️⃣ FEATURE ENGINEERING
 # =========================
-def build_advanced_features(df: pd.DataFrame, point_line: float) -> pd.DataFrame:
-    """Costruisce feature avanzate"""
-    df = df.copy()
-    n = len(df)
-    
-    # Finestre rolling adattive
+def _rolling_windows(n: int) -> tuple:
+    """Finestre rolling adattive (short, medium, long) per n partite"""
     w_short = min(5, max(3, n // 4))
     w_medium = min(10, max(5, n // 3))
     w_long = min(15, max(8, n // 2))
+    return w_short, w_medium, w_long
+
+
+def build_base_features(df: pd.DataFrame) -> pd.DataFrame:
+    """Feature che non dipendono dalla soglia: calcolabili una volta per più soglie"""
+    pts = df["PTS"]
+    w_short, w_medium, w_long = _rolling_windows(len(df))
+    
+    # Le feature finiscono in un dict e vengono aggiunte al DataFrame con un solo concat
+    feat = {}
     
     # PUNTI
-    df["avg_pts_last3"] = df["PTS"].rolling(3, min_periods=1).mean()
-    df["avg_pts_last5"] = df["PTS"].rolling(w_short, min_periods=2).mean()
-    df["avg_pts_last10"] = df["PTS"].rolling(w_medium, min_periods=3).mean()
-    df["avg_pts_season"] = df["PTS"].expanding(min_periods=1).mean()
+    feat["avg_pts_last3"] = pts.rolling(3, min_periods=1).mean()
+    feat["avg_pts_last5"] = pts.rolling(w_short, min_periods=2).mean()
+    feat["avg_pts_last10"] = pts.rolling(w_medium, min_periods=3).mean()
+    feat["avg_pts_season"] = pts.expanding(min_periods=1).mean()
     
     # Volatilità
-    df["std_pts_last10"] = df["PTS"].rolling(w_medium, min_periods=3).std()
-    df["cv_pts"] = df["std_pts_last10"] / (df["avg_pts_last10"] + 1e-6)
+    feat["std_pts_last10"] = pts.rolling(w_medium, min_periods=3).std()
+    feat["cv_pts"] = feat["std_pts_last10"] / (feat["avg_pts_last10"] + 1e-6)
     
     # Trend
-    df["trend_pts"] = df["avg_pts_last5"] - df["avg_pts_last10"]
-    df["margin_vs_line"] = df["avg_pts_last10"] - point_line
-    
-    # EFFICIENZA
-    df["TS%"] = df["PTS"] / (2 * (df["FGA"] + 0.44 * df["FTA"]) + 1e-6)
-    df["avg_TS"] = df["TS%"].rolling(w_short, min_periods=2).mean()
-    df["avg_eFG"] = df["eFG%"].rolling(w_short, min_periods=2).mean()
-    df["pts_per_min"] = df["PTS"] / (df["MP_min"] + 1e-6)
-    df["avg_pts_per_min"] = df["pts_per_min"].rolling(w_short, min_periods=2).mean()
-    
-    # UTILIZZO
-    df["usage_proxy"] = df["FGA"] + 0.44 * df["FTA"] + df["TOV"]
-    df["avg_usage"] = df["usage_proxy"].rolling(w_short, min_periods=2).mean()
-    df["avg_fga"] = df["FGA"].rolling(w_short, min_periods=2).mean()
-    df["avg_fta"] = df["FTA"].rolling(w_short, min_periods=2).mean()
-    
-    # IMPATTO
-    df["avg_gmsc"] = df["GmSc"].rolling(w_short, min_periods=2).mean()
-    df["avg_plusminus"] = df["+/-"].rolling(w_short, min_periods=2).mean()
-    df["avg_ast"] = df["AST"].rolling(w_short, min_periods=2).mean()
-    
-    # PERCENTUALI
-    df["avg_fg_pct"] = df["FG%"].rolling(w_short, min_periods=2).mean()
-    df["avg_3p_pct"] = df["3P%"].rolling(w_short, min_periods=2).mean()
-    df["avg_ft_pct"] = df["FT%"].rolling(w_short, min_periods=2).mean()
-    
-    # MINUTI
-    df["avg_minutes"] = df["MP_min"].rolling(w_short, min_periods=2).mean()
-    
-    # CONSISTENZA
-    def rolling_over_pct(series, window, threshold):
-        return series.rolling(window, min_periods=max(1, window-2)).apply(
-            lambda x: (x > threshold).mean()
-        )
-    
-    df["pct_over_last5"] = rolling_over_pct(df["PTS"], w_short, point_line)
-    df["pct_over_last10"] = rolling_over_pct(df["PTS"], w_medium, point_line)
-    
-    # STREAK
-    def get_streak(series, threshold):
-        streaks = []
-        current_streak = 0
-        for val in series:
-            if pd.isna(val):
-                streaks.append(0)
-            elif val > threshold:
-                current_streak = current_streak + 1 if current_streak >= 0 else 1
-                streaks.append(current_streak)
-            else:
-                current_streak = current_streak - 1 if current_streak <= 0 else -1
-                streaks.append(current_streak)
-        return streaks
-    
-    df["streak"] = get_streak(df["PTS"].values, point_line)
+    feat["trend_pts"] = feat["avg_pts_last5"] - feat["avg_pts_last10"]
+    
+    # Colonne derivate per partita
+    derived = pd.DataFrame({
+        "TS%": pts / (2 * (df["FGA"] + 0.44 * df["FTA"]) + 1e-6),
+        "pts_per_min": pts / (df["MP_min"] + 1e-6),
+        "usage_proxy": df["FGA"] + 0.44 * df["FTA"] + df["TOV"],
+    }, index=df.index)
+    
+    # Medie mobili brevi: una sola rolling() 2D su tutte le colonne sorgente
+    short_rolling = {
+        "avg_TS": "TS%", "avg_eFG": "eFG%", "avg_pts_per_min": "pts_per_min",             # EFFICIENZA
+        "avg_usage": "usage_proxy", "avg_fga": "FGA", "avg_fta": "FTA",                   # UTILIZZO
+        "avg_gmsc": "GmSc", "avg_plusminus": "+/-", "avg_ast": "AST",                     # IMPATTO
+        "avg_fg_pct": "FG%", "avg_3p_pct": "3P%", "avg_ft_pct": "FT%",                    # PERCENTUALI
+        "avg_minutes": "MP_min",                                                          # MINUTI
+    }
+    sources = pd.concat([df, derived], axis=1)[list(short_rolling.values())]
+    short_means = sources.rolling(w_short, min_periods=2).mean()
+    for feature, source in short_rolling.items():
+        feat[feature] = short_means[source]
+    
+    # Colonne già presenti vengono sostituite, come con le assegnazioni df[col] = ...
+    new_cols = pd.concat([derived, pd.DataFrame(feat, index=df.index)], axis=1)
+    return pd.concat([df.drop(columns=new_cols.columns, errors="ignore"), new_cols], axis=1)
+
+
+def add_line_features(df_base: pd.DataFrame, point_line: float) -> pd.DataFrame:
+    """Aggiunge a build_base_features le feature che dipendono dalla soglia"""
+    pts = df_base["PTS"]
+    w_short, w_medium, _ = _rolling_windows(len(df_base))
     
-    return df
+    # Media mobile di un booleano (niente callback Python per finestra): i NaN contano
+    # come UNDER nella media ma non per min_periods, come con rolling().apply()
+    def rolling_over_pct(series, window, threshold):
+        pct = series.gt(threshold).astype(np.float64).rolling(window, min_periods=1).mean()
+        valid = series.notna().rolling(window, min_periods=1).sum() >= max(1, window-2)
+        return pct.where(valid)
+    
+    return df_base.assign(
+        margin_vs_line=df_base["avg_pts_last10"] - point_line,                          # Trend
+        pct_over_last5=rolling_over_pct(pts, w_short, point_line),                      # CONSISTENZA
+        pct_over_last10=rolling_over_pct(pts, w_medium, point_line),
+        streak=_streak_kernel(pts.to_numpy(dtype=np.float64), float(point_line)),       # STREAK
+    )
+
+
+def build_advanced_features(df: pd.DataFrame, point_line: float) -> pd.DataFrame:
+    """Costruisce feature avanzate"""
+    return add_line_features(build_base_features(df), point_line)
 
 
 # =========================
@@ -269,6 +381,14 @@ def get_feature_columns() -> list:
 # =========================
 # 4️⃣ ENSEMBLE MODEL
 # =========================
+class _ScaledLogisticRegression(Pipeline):
+    """StandardScaler → LogisticRegression che accetta sample_weight come un estimatore semplice"""
+    
+    def fit(self, X, y, sample_weight=None):
+        # VotingClassifier passa sample_weight=..., Pipeline vuole <step>__sample_weight
+        return super().fit(X, y, lr__sample_weight=sample_weight)
+
+
 def train_ensemble_model(df: pd.DataFrame, point_line: float):
     """Addestra ensemble di modelli"""
     df = df.copy()
@@ -280,7 +400,7 @@ def train_ensemble_model(df: pd.DataFrame, point_line: float):
     if len(available_features) < 5:
         raise ValueError("Non abbastanza feature valide")
     
-    X = df[available_features].fillna(df[available_features].median())
+    X = df[available_features].fillna(df[available_features].median().astype(np.float32)).to_numpy(dtype=np.float32)
     y = df["over"]
     
     if y.nunique() < 2:
@@ -290,31 +410,68 @@ def train_ensemble_model(df: pd.DataFrame, point_line: float):
     n = len(df)
     time_weights = np.linspace(0.5, 1.0, n)
     
-    # Standardizzazione
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-    
-    # Modelli
-    lr = LogisticRegression(penalty="l2", C=0.5, class_weight="balanced", max_iter=2000, random_state=42)
-    rf = RandomForestClassifier(n_estimators=100, max_depth=5, min_samples_split=10, 
-                                min_samples_leaf=5, class_weight="balanced", random_state=42)
+    # Modelli: solo la LR è sensibile alla scala, gli alberi lavorano sulla matrice raw.
+    # Scaler con copia: X è condivisa con HGB e la LR non deve standardizzarla in place
+    lr = _ScaledLogisticRegression([
+        ("scaler", StandardScaler()),
+        ("lr", LogisticRegression(penalty="l2", C=0.5, class_weight="balanced", max_iter=2000, random_state=42)),
+    ])
     
-    estimators = [('lr', lr), ('rf', rf)]
-    
-    if XGBOOST_AVAILABLE:
-        xgb = XGBClassifier(n_estimators=100, max_depth=4, learning_rate=0.1, 
-                           subsample=0.8, colsample_bytree=0.8, random_state=42, eval_metric='logloss')
-        estimators.append(('xgb', xgb))
+    # Boosting a istogrammi (scikit-learn >= 1.4): molto più rapido di RF da 100 alberi e copre già il ruolo di XGBoost
+    hgb = HistGradientBoostingClassifier(max_iter=80, max_depth=4, learning_rate=0.08,
+                                         l2_regularization=1.0, min_samples_leaf=5,
+                                         class_weight="balanced", random_state=42)
+    estimators = [('lr', lr), ('hgb', hgb)]
     
     ensemble = VotingClassifier(estimators=estimators, voting='soft')
-    ensemble.fit(X_scaled, y, sample_weight=time_weights)
+    ensemble.fit(X, y, sample_weight=time_weights)
     
     try:
         calibrated_model = CalibratedClassifierCV(ensemble, method='isotonic', cv='prefit')
-        calibrated_model.fit(X_scaled, y, sample_weight=time_weights)
-        return calibrated_model, scaler, available_features
+        calibrated_model.fit(X, y, sample_weight=time_weights)
+        return calibrated_model, available_features
     except:
-        return ensemble, scaler, available_features
+        return ensemble, available_features
+
+
+_MODEL_CACHE = OrderedDict()  # {(hash matrice di training, n righe, point_line): (model, features, last3)}, LRU
+_MODEL_CACHE_MAX = 256        # ~150 KB per ensemble addestrato
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def _training_key(df_feat: pd.DataFrame, point_line: float) -> tuple:
+    """Chiave del modello: byte della matrice feature + PTS (target) e soglia"""
+    cols = [f for f in get_feature_columns() if f in df_feat.columns] + ["PTS"]
+    matrix = np.ascontiguousarray(df_feat[cols].to_numpy(dtype=np.float64))
+    return _hash_bytes(matrix.tobytes()), len(df_feat), float(point_line)
+
+
+def get_trained_model(df_feat: pd.DataFrame, point_line: float):
+    """
+    train_ensemble_model con cache LRU sulla matrice di training
+    
+    Il training è deterministico (random_state fisso): stessa matrice e stessa soglia
+    danno lo stesso modello. Una nuova partita cambia i byte, quindi niente TTL.
+    Le ultime 3 righe fanno parte della matrice: il loro input va in cache col modello.
+    """
+    key = _training_key(df_feat, point_line)
+    with _MODEL_CACHE_LOCK:
+        trained = _MODEL_CACHE.get(key)
+        if trained is not None:
+            _MODEL_CACHE.move_to_end(key)
+            return trained
+    
+    model, features = train_ensemble_model(df_feat, point_line)
+    # NaN → 0 in place sulla copia raw: la scala della LR la applica la pipeline
+    last3 = df_feat.tail(3)[features].to_numpy(dtype=np.float32, copy=True)
+    np.nan_to_num(last3, copy=False, nan=0.0)
+    trained = (model, features, last3)
+    
+    with _MODEL_CACHE_LOCK:
+        _MODEL_CACHE[key] = trained
+        while len(_MODEL_CACHE) > _MODEL_CACHE_MAX:
+            _MODEL_CACHE.popitem(last=False)
+    return trained
 
 
 # =========================
@@ -324,7 +481,6 @@ def final_over_probability(
     df: pd.DataFrame,
     point_line: float = 22.5,
     recent_games: int = 35,
-    monte_carlo_simulations: int = 1000,
     enforce_mono: bool = True  # ← NUOVO PARAMETRO
 ) -> dict:
     """
@@ -334,115 +490,199 @@ def final_over_probability(
         enforce_mono: Se True, applica correzione monotonicità
     """
     
-    df_recent = df.tail(recent_games).reset_index(drop=True)
+    # Slice posizionale senza reset_index: le feature lavorano sull'indice che trovano
+    df_recent = df.iloc[max(len(df) - recent_games, 0):]
+    return _over_probability_recent(df_recent, point_line, enforce_mono)
+
+
+def final_over_probabilities(
+    df: pd.DataFrame,
+    point_lines,
+    recent_games: int = 35,
+    enforce_mono: bool = True
+) -> list:
+    """
+    Come final_over_probability, ma su più soglie in una sola chiamata
+    
+    Campione recente, quantili, frequenze empiriche OVER, hash del giocatore e feature
+    indipendenti dalla soglia sono calcolati una volta per tutte le soglie; le soglie sono processate nell'ordine
+    ricevuto (stesso effetto sulla cache di monotonicità di N chiamate).
+    
+    Returns:
+        lista di dict, uno per soglia, nello stesso formato di final_over_probability
+    """
+    lines = np.asarray(point_lines, dtype=float)
+    df_recent = df.iloc[max(len(df) - recent_games, 0):]
+    
+    pts = df_recent["PTS"].to_numpy(dtype=np.float64)
+    empirical = (pts[:, None] > lines[None, :]).mean(axis=0) * 100
+    realistic = _realistic_range(pts) if len(df_recent) >= 5 else None
+    
+    # Stesso campione per tutte le soglie: hash per la cache di monotonicità una volta sola
+    player_hash = get_player_hash(df_recent) if enforce_mono else None
+    
+    # Feature indipendenti dalla soglia: una volta sola (se falliscono, ogni soglia
+    # le ricalcola e ricade nel proprio fallback_error come prima)
+    base_features = None
+    if realistic is not None:
+        try:
+            base_features = build_base_features(df_recent)
+        except Exception:
+            base_features = None
+    
+    # Prima le raw di tutte le soglie, poi un solo PAV: la risposta è monotona per costruzione
+    recent = [
+        _raw_over_probability_recent(df_recent, float(line), realistic, prob, base_features)
+        for line, prob in zip(lines, empirical)
+    ]
+    ml = [i for i, (_, raw_probability) in enumerate(recent) if raw_probability is not None]
+    mono_results = (
+        enforce_monotonicity_batch([float(lines[i]) for i in ml], [recent[i][1] for i in ml], df_recent, player_hash)
+        if enforce_mono and ml else [None] * len(ml)
+    )
+    for i, mono_result in zip(ml, mono_results):
+        _finish_ml_result(recent[i][0], recent[i][1], mono_result)
+    return [result for result, _ in recent]
+
+
+def _realistic_range(pts: np.ndarray) -> tuple:
+    """Intervallo di soglie realistiche (quantili 5% - 95% dei punti recenti, NaN esclusi)"""
+    min_realistic, max_realistic = np.nanquantile(pts, [0.05, 0.95])
+    return min_realistic, max_realistic
+
+
+def _over_probability_recent(
+    df_recent: pd.DataFrame,
+    point_line: float,
+    enforce_mono: bool = True,
+    realistic: tuple = None,
+    empirical_prob: float = None,
+    base_features: pd.DataFrame = None,
+    player_hash: int = None
+) -> dict:
+    """Probabilità OVER per una soglia, dato il campione recente già estratto"""
+    result, raw_probability = _raw_over_probability_recent(df_recent, point_line, realistic, empirical_prob, base_features)
+    if raw_probability is not None:
+        mono_result = enforce_monotonicity(point_line, raw_probability, df_recent, player_hash) if enforce_mono else None
+        _finish_ml_result(result, raw_probability, mono_result)
+    return result
+
+
+def _finish_ml_result(result: dict, raw_probability: float, mono_result: dict = None):
+    """Completa in place il risultato ML con la probabilità finale (monotona se mono_result)"""
+    if mono_result is not None:
+        final_prob = mono_result["probability"]
+        adjusted = mono_result["adjusted"]
+        method = f"ensemble_ml ({mono_result['method']})"
+    else:
+        final_prob = raw_probability
+        adjusted = False
+        method = "ensemble_ml (no_adjustment)"
+    
+    result["probability"] = round(final_prob, 2)
+    result["method_used"] = method
+    result["adjusted"] = adjusted
+    
+    # Se aggiustato, aggiungi metadata
+    if adjusted:
+        result["original_probability"] = round(raw_probability, 2)
+
+
+def _raw_over_probability_recent(
+    df_recent: pd.DataFrame,
+    point_line: float,
+    realistic: tuple = None,
+    empirical_prob: float = None,
+    base_features: pd.DataFrame = None
+) -> tuple:
+    """
+    Risultato per una soglia senza monotonicità
+    
+    Returns:
+        (result, raw_probability): raw_probability è None se il risultato è già
+        definitivo (fallback empirici), altrimenti è la raw ML ancora da completare
+    """
     n_games = len(df_recent)
+    pts = df_recent["PTS"].to_numpy(dtype=np.float64)  # estratto una volta per tutti i rami
+    if empirical_prob is None:
+        empirical_prob = _over_rate_kernel(pts, float(point_line))
     
     # Caso 1: Pochissimi dati
     if n_games < 5:
-        prob = df_recent["PTS"].gt(point_line).mean() * 100
         return {
-            "probability": round(prob, 2),
+            "probability": round(empirical_prob, 2),
             "confidence": "very_low",
             "method_used": "empirical_fallback",
             "sample_size": n_games,
             "adjusted": False
-        }
+        }, None
     
     # Caso 2: Soglia irrealistica
-    max_realistic = df_recent["PTS"].quantile(0.95)
-    min_realistic = df_recent["PTS"].quantile(0.05)
+    min_realistic, max_realistic = realistic if realistic is not None else _realistic_range(pts)
     
     if point_line > max_realistic:
-        prob = df_recent["PTS"].gt(point_line).mean() * 100
         return {
-            "probability": round(prob, 2),
+            "probability": round(empirical_prob, 2),
             "confidence": "low",
             "method_used": "extreme_threshold_high",
             "sample_size": n_games,
             "adjusted": False
-        }
+        }, None
     
     if point_line < min_realistic:
-        prob = df_recent["PTS"].gt(point_line).mean() * 100
         return {
-            "probability": round(prob, 2),
+            "probability": round(empirical_prob, 2),
             "confidence": "low",
             "method_used": "extreme_threshold_low",
             "sample_size": n_games,
             "adjusted": False
-        }
+        }, None
     
     # Caso 3: ML
     try:
-        df_feat = build_advanced_features(df_recent, point_line)
-        df_feat = df_feat.dropna(subset=["avg_pts_last5", "avg_pts_last10"], how='any')
+        if base_features is None:
+            base_features = build_base_features(df_recent)
+        df_feat = add_line_features(base_features, point_line)
+        # Maschera NumPy sulle due colonne invece di dropna (niente allineamento per label)
+        valid = ~(np.isnan(df_feat["avg_pts_last5"].to_numpy()) | np.isnan(df_feat["avg_pts_last10"].to_numpy()))
+        df_feat = df_feat.iloc[valid]
         
         if len(df_feat) < 8:
-            weights = np.linspace(0.5, 1.0, n_games)
-            prob = np.average(df_recent["PTS"].gt(point_line), weights=weights) * 100
+            prob = _weighted_over_kernel(pts, float(point_line), 0.5, 1.0)
             return {
                 "probability": round(prob, 2),
                 "confidence": "low",
                 "method_used": "weighted_empirical",
                 "sample_size": n_games,
                 "adjusted": False
-            }
-        
-        model, scaler, features = train_ensemble_model(df_feat, point_line)
+            }, None
         
-        last_game = df_feat.iloc[-1][features].values.reshape(1, -1)
-        last_game = np.nan_to_num(last_game, nan=0)
-        last_scaled = scaler.transform(last_game)
+        model, features, last3 = get_trained_model(df_feat, point_line)
         
-        prob_over = model.predict_proba(last_scaled)[0][1]
-        
-        # Media ultime 3 predizioni
-        if len(df_feat) >= 3:
-            last_3_games = df_feat.tail(3)[features].values
-            last_3_games = np.nan_to_num(last_3_games, nan=0)
-            last_3_scaled = scaler.transform(last_3_games)
-            probs_3 = model.predict_proba(last_3_scaled)[:, 1]
-            weights = np.array([0.2, 0.3, 0.5])
-            prob_over = np.average(probs_3, weights=weights)
+        # Media pesata delle ultime 3 predizioni: input già pronto in cache, un solo predict_proba
+        probs = model.predict_proba(last3)[:, 1]
+        if len(probs) == 3:
+            prob_over = np.average(probs, weights=np.array([0.2, 0.3, 0.5]))
+        else:
+            prob_over = probs[-1]
         
         raw_probability = prob_over * 100
         
-        # ===== POST-PROCESSING MONOTONICITÀ =====
-        if enforce_mono:
-            mono_result = enforce_monotonicity(point_line, raw_probability, df_recent)
-            final_prob = mono_result["probability"]
-            adjusted = mono_result["adjusted"]
-            method = f"ensemble_ml ({mono_result['method']})"
-        else:
-            final_prob = raw_probability
-            adjusted = False
-            method = "ensemble_ml (no_adjustment)"
-        
+        # ===== POST-PROCESSING MONOTONICITÀ: a carico del chiamante (_finish_ml_result) =====
         confidence = "high" if n_games >= 25 else "medium" if n_games >= 15 else "low"
         
         result = {
-            "probability": round(final_prob, 2),
+            "probability": round(raw_probability, 2),
             "confidence": confidence,
-            "method_used": method,
+            "method_used": "ensemble_ml (no_adjustment)",
             "sample_size": len(df_feat),
             "features_used": len(features),
-            "adjusted": adjusted
+            "adjusted": False
         }
-        
-        # Se aggiustato, aggiungi metadata
-        if adjusted and enforce_mono:
-            result["original_probability"] = round(raw_probability, 2)
-            if "reference_threshold" in mono_result:
-                result["adjustment_info"] = {
-                    "reference_threshold": mono_result["reference_threshold"],
-                    "reference_prob": round(mono_result["reference_prob"], 2)
-                }
-        
-        return result
+        return result, raw_probability
         
     except Exception as e:
-        weights = np.linspace(0.5, 1.0, n_games)
-        prob = np.average(df_recent["PTS"].gt(point_line), weights=weights) * 100
+        prob = _weighted_over_kernel(pts, float(point_line), 0.5, 1.0)
         
         return {
             "probability": round(prob, 2),
@@ -450,4 +690,4 @@ def final_over_probability(
             "method_used": f"fallback_error ({str(e)[:50]})",
             "sample_size": n_games,
             "adjusted": False
-        }
\ No newline at end of file
+        }, None
\ No newline at end of file
@@ -3,50 +3,191 @@ payments.py — Stripe + PayPal Subscriptions per NBA Over Predictor
 """
 
 import os
+import sys
+import time
+import atexit
+import queue
+import logging
+import logging.handlers
+import threading
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import hmac
+import base64
+import zlib
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import certifi
 import requests as http_requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import firebase_admin
 from firebase_admin import credentials, firestore as admin_firestore
 from flask import Blueprint, request, jsonify
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    CRYPTOGRAPHY_AVAILABLE = True
+except ImportError:
+    CRYPTOGRAPHY_AVAILABLE = False
+
+# Log non bloccanti: i thread delle richieste accodano, un listener scrive su stdout
+log = logging.getLogger("payments")
+# LOG_LEVEL sconosciuto: INFO (avviso sotto, a handler pronto) invece di un ValueError all'import
+_LOG_LEVEL = getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), None)
+log.setLevel(_LOG_LEVEL if isinstance(_LOG_LEVEL, int) else logging.INFO)
+log.propagate = False
+_LOG_QUEUE = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_LOG_QUEUE))
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler(sys.stdout))
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)  # svuota la coda all'uscita del worker
+if not isinstance(_LOG_LEVEL, int):
+    log.warning("[payments] LOG_LEVEL=%s non valido, uso INFO", os.environ.get("LOG_LEVEL"))
+
 payments_bp = Blueprint("payments", __name__)
 
+# Lavori Firestore fuori dalla richiesta (webhook Stripe, indice alla creazione dell'abbonamento)
+_WEBHOOK_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="payments-bg")
+
+# Consegne webhook già ricevute: {(provider, id): istante monotonic}, LRU con TTL.
+# I retry del provider rispondono 200 subito, senza verifica né scritture
+_RECENT_WEBHOOKS      = OrderedDict()
+_RECENT_WEBHOOKS_MAX  = 10_000
+_RECENT_WEBHOOKS_TTL  = 600
+_RECENT_WEBHOOKS_LOCK = threading.Lock()
+
+
+def _webhook_seen(provider: str, delivery_id: str, mark: bool = True) -> bool:
+    """True se la consegna è già arrivata negli ultimi 10 minuti; altrimenti la registra (se mark)"""
+    if not delivery_id:
+        return False
+    key = (provider, delivery_id)
+    now = time.monotonic()
+    with _RECENT_WEBHOOKS_LOCK:
+        seen_at = _RECENT_WEBHOOKS.get(key)
+        if seen_at is not None and now - seen_at < _RECENT_WEBHOOKS_TTL:
+            return True
+        if not mark:
+            return False
+        _RECENT_WEBHOOKS[key] = now
+        _RECENT_WEBHOOKS.move_to_end(key)
+        while _RECENT_WEBHOOKS and (
+            len(_RECENT_WEBHOOKS) > _RECENT_WEBHOOKS_MAX
+            or now - next(iter(_RECENT_WEBHOOKS.values())) >= _RECENT_WEBHOOKS_TTL
+        ):
+            _RECENT_WEBHOOKS.popitem(last=False)
+    return False
+
+
+def _json_body() -> dict:
+    # Body assente/malformato → {}: la validazione dei campi risponde 400 prima di token o Firestore
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
 # ============================================================
 # FIREBASE ADMIN
 # ============================================================
 
+# Service account normalizzato una volta all'import (le \\n della variabile Railway diventano a capo)
+_SERVICE_ACCOUNT = {
+    "type": "service_account",
+    "project_id":   os.environ.get("FIREBASE_PROJECT_ID", ""),
+    "private_key":  os.environ.get("FIREBASE_PRIVATE_KEY", "").replace("\\n", "\n"),
+    "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL", ""),
+    "token_uri":    "https://oauth2.googleapis.com/token",
+}
+
+_DB      = None  # client Firestore creato una volta e riusato da tutte le route
+_DB_LOCK = threading.Lock()
+
+
 def get_admin_db():
+    global _DB
+    if _DB is not None:
+        return _DB
+    with _DB_LOCK:
+        # Route, consumer webhook e pool possono arrivare qui insieme al primo uso:
+        # initialize_app due volte solleverebbe ValueError
+        if _DB is None:
+            _DB = _init_admin_db()
+    return _DB
+
+
+def _init_admin_db():
     if not firebase_admin._apps:
-        private_key = os.environ.get("FIREBASE_PRIVATE_KEY", "")
-        private_key = private_key.replace("\\n", "\n")
-        service_account = {
-            "type": "service_account",
-            "project_id":   os.environ.get("FIREBASE_PROJECT_ID", ""),
-            "private_key":  private_key,
-            "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL", ""),
-            "token_uri":    "https://oauth2.googleapis.com/token",
-        }
-        cred = credentials.Certificate(service_account)
-        firebase_admin.initialize_app(cred)
+        cred = credentials.Certificate(_SERVICE_ACCOUNT)
+        # projectId esplicito: il client Firestore non sonda il metadata server GCP
+        firebase_admin.initialize_app(cred, {"projectId": _SERVICE_ACCOUNT["project_id"]})
     return admin_firestore.client()
 
 
-def set_user_premium(uid: str):
-    db = get_admin_db()
-    db.collection("users").document(uid).set(
-        {"plan": "premium", "plan_updated_at": admin_firestore.SERVER_TIMESTAMP},
+def _set_user_plan(uid: str, plan: str, extras: dict = None, index: tuple = None, batch=None):
+    # Piano + campi extra (+ eventuale indice inverso) in un solo commit: un RPC invece di 2-3.
+    # Con un batch esterno le scritture vengono solo accodate: il commit spetta al chiamante
+    db     = get_admin_db()
+    commit = batch is None
+    if commit:
+        batch = db.batch()
+    batch.set(
+        db.collection("users").document(uid),
+        {"plan": plan, "plan_updated_at": admin_firestore.SERVER_TIMESTAMP, **(extras or {})},
         merge=True
     )
+    if index:
+        collection, key = index
+        batch.set(db.collection(collection).document(key), {"uid": uid})
+    if commit:
+        batch.commit()
 
 
-def set_user_free(uid: str):
-    db = get_admin_db()
-    db.collection("users").document(uid).set(
-        {"plan": "free", "plan_updated_at": admin_firestore.SERVER_TIMESTAMP},
-        merge=True
-    )
+def set_user_premium(uid: str, extras: dict = None, index: tuple = None, batch=None):
+    _set_user_plan(uid, "premium", extras, index, batch)
+
+
+def set_user_free(uid: str, extras: dict = None, batch=None):
+    _set_user_plan(uid, "free", extras, batch=batch)
+
+
+# Indici inversi id esterno → uid: i webhook risolvono l'utente con una GET per chiave
+STRIPE_CUSTOMERS_INDEX     = "stripe_customers"
+PAYPAL_SUBSCRIPTIONS_INDEX = "paypal_subscriptions"
+
+
+def index_external_id(index: str, key: str, uid: str):
+    get_admin_db().collection(index).document(key).set({"uid": uid})
+
+
+def _index_external_id_background(index: str, key: str, uid: str):
+    # Nel pool nessuno legge il Future: l'errore va loggato qui o si perde
+    try:
+        index_external_id(index, key, uid)
+    except Exception as e:
+        log.error("[Firestore] Errore indice %s/%s: %s", index, key, e)
+
+
+def lookup_uids(index: str, field: str, key: str) -> list:
+    db   = get_admin_db()
+    snap = db.collection(index).document(key).get()
+    uid  = (snap.to_dict() or {}).get("uid") if snap.exists else None
+    if uid:
+        return [uid]
+    # Utenti salvati prima dell'indice: query su users una volta sola, poi backfill
+    uids = [doc.id for doc in db.collection("users").where(field, "==", key).stream()]
+    for uid in uids:
+        index_external_id(index, key, uid)
+    return uids
 
 
 # ============================================================
@@ -61,7 +202,7 @@ try:
     STRIPE_ENABLED = bool(stripe.api_key)
 except ImportError:
     STRIPE_ENABLED = False
-    print("[payments] stripe non installato")
+    log.warning("[payments] stripe non installato")
 
 STRIPE_PRICE_ID       = os.environ.get("STRIPE_PRICE_ID", "")
 STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET", "")
@@ -72,7 +213,7 @@ APP_URL               = os.environ.get("APP_URL", "https://nbaoverpredictor.it")
 def stripe_create_checkout():
     if not STRIPE_ENABLED:
         return jsonify({"error": "Stripe non configurato"}), 500
-    data  = request.get_json()
+    data  = _json_body()
     uid   = data.get("uid")
     email = data.get("email", "")
     if not uid:
@@ -104,34 +245,51 @@ def stripe_webhook():
     except Exception:
         return jsonify({"error": "Webhook non valido"}), 400
 
+    # stripe.Event non è un dict (niente .get): attributi o indici
+    if _webhook_seen("stripe", event.id):
+        log.debug("[Stripe] Evento duplicato ignorato id=%s", event.id)
+        return jsonify({"received": True}), 200
+
+    # Firma già verificata (HMAC locale): Stripe riceve subito il 200, Firestore in background
+    _WEBHOOK_POOL.submit(_process_stripe_event, event)
+    return jsonify({"received": True}), 200
+
+
+def _process_stripe_event(event):
+    try:
+        _handle_stripe_event(event)
+    except Exception as e:
+        log.error("[Stripe] Errore elaborazione: %s", e)
+
+
+def _handle_stripe_event(event):
     event_type = event["type"]
     if event_type == "checkout.session.completed":
-        session_obj = event["data"]["object"]
+        # StripeObject → dict annidato: .get con default come sul payload JSON
+        session_obj = event["data"]["object"].to_dict()
         uid         = session_obj.get("metadata", {}).get("uid")
         customer_id = session_obj.get("customer")
         email       = session_obj.get("customer_email", "")
         if uid:
-            set_user_premium(uid)
             # Salva customer_id per il portale di gestione abbonamento
             if customer_id:
-                db = get_admin_db()
-                db.collection("users").document(uid).set(
-                    {"stripe_customer_id": customer_id, "email": email},
-                    merge=True
+                set_user_premium(
+                    uid,
+                    extras={"stripe_customer_id": customer_id, "email": email},
+                    index=(STRIPE_CUSTOMERS_INDEX, customer_id),
                 )
-            print(f"[Stripe] ✅ Premium attivato uid={uid} customer={customer_id}")
+            else:
+                set_user_premium(uid)
+            log.info("[Stripe] ✅ Premium attivato uid=%s customer=%s", uid, customer_id)
     elif event_type == "customer.subscription.deleted":
-        customer_id = event["data"]["object"].get("customer")
+        customer_id = event["data"]["object"].to_dict().get("customer")
         if customer_id:
             try:
-                db = get_admin_db()
-                docs = db.collection("users").where("stripe_customer_id", "==", customer_id).stream()
-                for doc in docs:
-                    set_user_free(doc.id)
-                    print(f"[Stripe] ⬇️ Piano Free ripristinato uid={doc.id}")
+                for uid in lookup_uids(STRIPE_CUSTOMERS_INDEX, "stripe_customer_id", customer_id):
+                    set_user_free(uid)
+                    log.info("[Stripe] ⬇️ Piano Free ripristinato uid=%s", uid)
             except Exception as e:
-                print(f"[Stripe] Errore: {e}")
-    return jsonify({"received": True}), 200
+                log.error("[Stripe] Errore: %s", e)
 
 
 @payments_bp.route("/stripe/customer-portal", methods=["POST"])
@@ -139,7 +297,7 @@ def stripe_customer_portal():
     if not STRIPE_ENABLED:
         return jsonify({"error": "Stripe non configurato"}), 500
 
-    data  = request.get_json()
+    data  = _json_body()
     uid   = data.get("uid")
     if not uid:
         return jsonify({"error": "uid mancante"}), 400
@@ -170,7 +328,8 @@ def stripe_customer_portal():
                     db.collection("users").document(uid).set(
                         {"stripe_customer_id": customer_id, "email": email}, merge=True
                     )
-                    print(f"[Stripe portal] customer_id trovato per email={email}: {customer_id}")
+                    index_external_id(STRIPE_CUSTOMERS_INDEX, customer_id, uid)
+                    log.info("[Stripe portal] customer_id trovato per email=%s: %s", email, customer_id)
 
         if not customer_id:
             return jsonify({"error": "Nessun abbonamento Stripe trovato. Hai sottoscritto con PayPal?"}), 404
@@ -182,7 +341,7 @@ def stripe_customer_portal():
         return jsonify({"url": session.url})
 
     except Exception as e:
-        print(f"[Stripe portal] Errore: {e}")
+        log.error("[Stripe portal] Errore: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -191,7 +350,7 @@ def stripe_cancel_subscription():
     if not STRIPE_ENABLED:
         return jsonify({"error": "Stripe non configurato"}), 500
 
-    data = request.get_json()
+    data = _json_body()
     uid  = data.get("uid")
     if not uid:
         return jsonify({"error": "uid mancante"}), 400
@@ -219,6 +378,7 @@ def stripe_cancel_subscription():
                     db.collection("users").document(uid).set(
                         {"stripe_customer_id": customer_id, "email": email}, merge=True
                     )
+                    index_external_id(STRIPE_CUSTOMERS_INDEX, customer_id, uid)
 
         if not customer_id:
             return jsonify({"error": "Nessun abbonamento Stripe trovato"}), 404
@@ -231,11 +391,11 @@ def stripe_cancel_subscription():
         sub = subscriptions.data[0]
         stripe.Subscription.modify(sub.id, cancel_at_period_end=True)
         set_user_free(uid)
-        print(f"[Stripe] ⬇️ Cancellazione pianificata uid={uid} sub={sub.id}")
+        log.info("[Stripe] ⬇️ Cancellazione pianificata uid=%s sub=%s", uid, sub.id)
         return jsonify({"success": True})
 
     except Exception as e:
-        print(f"[Stripe cancel] Errore: {e}")
+        log.error("[Stripe cancel] Errore: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -257,62 +417,136 @@ PAYPAL_BASE_URL   = (
     else "https://api-m.sandbox.paypal.com"
 )
 
+# Endpoint fissi per ambiente: formattati una volta al caricamento del modulo
+_PP_OAUTH_URL  = f"{PAYPAL_BASE_URL}/v1/oauth2/token"
+_PP_SUB_URL    = f"{PAYPAL_BASE_URL}/v1/billing/subscriptions"
+_PP_VERIFY_URL = f"{PAYPAL_BASE_URL}/v1/notifications/verify-webhook-signature"
+
+# Parte fissa del body di create-subscription: per richiesta cambia solo custom_id
+_PP_SUB_APP_CTX = {
+    "brand_name": "NBA Over Predictor",
+    "locale": "it-IT",
+    "shipping_preference": "NO_SHIPPING",
+    "user_action": "SUBSCRIBE_NOW",
+    "return_url": f"{APP_URL}/premium.html?payment=success&provider=paypal",
+    "cancel_url": f"{APP_URL}/premium.html?payment=cancel",
+}
+
+# Sessione keep-alive verso PayPal: niente handshake TCP+TLS a ogni chiamata.
+# I 502/503/504 transitori sono ritentati solo sui metodi idempotenti (default urllib3: POST escluso)
+_PAYPAL_SESSION = http_requests.Session()
+_PAYPAL_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False),
+))
+
+
+_PP_TOKEN      = {"value": None, "exp": 0.0}  # token OAuth PayPal fino a scadenza (monotonic)
+_PP_TOKEN_LOCK = threading.Lock()
+
+
+def _response_json(r):
+    # Risposte PayPal decodificate in C direttamente dai byte
+    return orjson.loads(r.content) if ORJSON_AVAILABLE else r.json()
+
 
 def paypal_get_access_token():
-    r = http_requests.post(
-        f"{PAYPAL_BASE_URL}/v1/oauth2/token",
-        auth=(PAYPAL_CLIENT_ID, PAYPAL_SECRET),
-        data={"grant_type": "client_credentials"},
-        timeout=10,
-    )
-    r.raise_for_status()
-    return r.json()["access_token"]
+    # Token valido (con 60s di margine) → nessuna chiamata OAuth
+    if _PP_TOKEN["value"] and time.monotonic() < _PP_TOKEN["exp"] - 60:
+        return _PP_TOKEN["value"]
+    with _PP_TOKEN_LOCK:
+        # Un altro thread potrebbe averlo appena rinnovato
+        if _PP_TOKEN["value"] and time.monotonic() < _PP_TOKEN["exp"] - 60:
+            return _PP_TOKEN["value"]
+        r = _PAYPAL_SESSION.post(
+            _PP_OAUTH_URL,
+            auth=(PAYPAL_CLIENT_ID, PAYPAL_SECRET),
+            data={"grant_type": "client_credentials"},
+            timeout=10,
+        )
+        r.raise_for_status()
+        token_data = _response_json(r)
+        _PP_TOKEN["value"] = token_data["access_token"]
+        _PP_TOKEN["exp"]   = time.monotonic() + float(token_data.get("expires_in", 0))
+        return _PP_TOKEN["value"]
+
+
+_PP_HEADERS = {"token": None, "headers": None}  # header ricostruiti solo quando il token ruota
 
 
 def paypal_headers():
-    return {
-        "Authorization": f"Bearer {paypal_get_access_token()}",
+    # Dict condiviso in sola lettura: requests non modifica gli header passati
+    global _PP_HEADERS
+    token  = paypal_get_access_token()
+    cached = _PP_HEADERS
+    if cached["token"] is token:
+        return cached["headers"]
+    headers = {
+        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
+    # Sostituzione atomica del riferimento: nessun lock, chi legge vede coppie coerenti
+    _PP_HEADERS = {"token": token, "headers": headers}
+    return headers
+
+
+def _paypal_drop_token(authorization: str):
+    # Scarta il token solo se è ancora quello usato: un altro thread può averlo già rinnovato
+    with _PP_TOKEN_LOCK:
+        if authorization == f"Bearer {_PP_TOKEN['value']}":
+            _PP_TOKEN["value"] = None
+            _PP_TOKEN["exp"]   = 0.0
+
+
+def paypal_request(method: str, url: str, **kwargs):
+    """Chiamata PayPal autenticata: su 401 (token revocato prima della scadenza) rinnova e ritenta una volta"""
+    if ORJSON_AVAILABLE and "json" in kwargs:
+        # Body serializzato in C; Content-Type application/json è già negli header
+        kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+    extra   = kwargs.pop("headers", None) or {}
+    headers = {**paypal_headers(), **extra} if extra else paypal_headers()
+    r = _PAYPAL_SESSION.request(method, url, headers=headers, **kwargs)
+    if r.status_code == 401:
+        _paypal_drop_token(headers["Authorization"])
+        headers = {**paypal_headers(), **extra} if extra else paypal_headers()
+        r = _PAYPAL_SESSION.request(method, url, headers=headers, **kwargs)
+    return r
 
 
 @payments_bp.route("/paypal/create-subscription", methods=["POST"])
 def paypal_create_subscription():
     if not PAYPAL_CLIENT_ID or not PAYPAL_PLAN_ID:
         return jsonify({"error": "PayPal non configurato"}), 500
-    data = request.get_json()
+    data = _json_body()
     uid  = data.get("uid")
     if not uid:
         return jsonify({"error": "uid mancante"}), 400
     try:
-        r = http_requests.post(
-            f"{PAYPAL_BASE_URL}/v1/billing/subscriptions",
-            headers=paypal_headers(),
+        r = paypal_request(
+            "POST",
+            _PP_SUB_URL,
+            # Servono solo id e link approve: niente rappresentazione completa
+            headers={"Prefer": "return=minimal"},
             json={
                 "plan_id": PAYPAL_PLAN_ID,
                 "custom_id": uid,
-                "application_context": {
-                    "brand_name": "NBA Over Predictor",
-                    "locale": "it-IT",
-                    "shipping_preference": "NO_SHIPPING",
-                    "user_action": "SUBSCRIBE_NOW",
-                    "return_url": f"{APP_URL}/premium.html?payment=success&provider=paypal",
-                    "cancel_url": f"{APP_URL}/premium.html?payment=cancel",
-                },
+                "application_context": _PP_SUB_APP_CTX,
             },
             timeout=15,
         )
         r.raise_for_status()
-        sub = r.json()
-        approval_url = next(
-            (link["href"] for link in sub.get("links", []) if link["rel"] == "approve"),
-            None
-        )
+        sub = _response_json(r)
+        links        = {link["rel"]: link["href"] for link in sub.get("links", [])}
+        approval_url = links.get("approve")
         if not approval_url:
             return jsonify({"error": "approval_url non trovato"}), 500
+        # Indice sub_id → uid dalla creazione (i webhook lo trovano anche prima di ACTIVATED),
+        # scritto in background: la risposta non aspetta Firestore
+        _WEBHOOK_POOL.submit(_index_external_id_background, PAYPAL_SUBSCRIPTIONS_INDEX, sub["id"], uid)
         return jsonify({"subscription_id": sub["id"], "approval_url": approval_url})
     except Exception as e:
-        print(f"[PayPal create-subscription] {e}")
+        log.error("[PayPal create-subscription] %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -320,32 +554,37 @@ def paypal_create_subscription():
 def paypal_verify_subscription():
     if not PAYPAL_CLIENT_ID:
         return jsonify({"error": "PayPal non configurato"}), 500
-    data   = request.get_json()
+    data   = _json_body()
     uid    = data.get("uid")
     sub_id = data.get("subscription_id")
     if not uid or not sub_id:
         return jsonify({"error": "uid o subscription_id mancante"}), 400
     try:
-        r = http_requests.get(
-            f"{PAYPAL_BASE_URL}/v1/billing/subscriptions/{sub_id}",
-            headers=paypal_headers(),
+        # Webhook ACTIVATED già arrivato: lo stato è in Firestore, niente GET verso PayPal
+        user_data = get_admin_db().collection("users").document(uid).get().to_dict() or {}
+        if user_data.get("plan") == "premium" and user_data.get("paypal_subscription_id") == sub_id:
+            log.debug("[PayPal verify] sub_id=%s già attivo uid=%s", sub_id, uid)
+            return jsonify({"success": True})
+        r = paypal_request(
+            "GET",
+            f"{_PP_SUB_URL}/{sub_id}",
             timeout=10,
         )
         r.raise_for_status()
-        sub    = r.json()
+        sub    = _response_json(r)
         status = sub.get("status")
-        print(f"[PayPal verify] sub_id={sub_id} status={status} uid={uid}")
+        log.debug("[PayPal verify] sub_id=%s status=%s uid=%s", sub_id, status, uid)
         if status == "ACTIVE":
-            set_user_premium(uid)
-            db = get_admin_db()
-            db.collection("users").document(uid).set(
-                {"paypal_subscription_id": sub_id}, merge=True
+            set_user_premium(
+                uid,
+                extras={"paypal_subscription_id": sub_id},
+                index=(PAYPAL_SUBSCRIPTIONS_INDEX, sub_id) if sub_id else None,
             )
-            print(f"[PayPal] ✅ Premium attivato uid={uid}")
+            log.info("[PayPal] ✅ Premium attivato uid=%s", uid)
             return jsonify({"success": True})
         return jsonify({"success": False, "status": status})
     except Exception as e:
-        print(f"[PayPal verify-subscription] {e}")
+        log.error("[PayPal verify-subscription] %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -353,73 +592,363 @@ def paypal_verify_subscription():
 def paypal_cancel_subscription():
     if not PAYPAL_CLIENT_ID:
         return jsonify({"error": "PayPal non configurato"}), 500
-    data   = request.get_json()
+    data   = _json_body()
     uid    = data.get("uid")
     sub_id = data.get("subscription_id")
     if not uid or not sub_id:
         return jsonify({"error": "uid o subscription_id mancante"}), 400
     try:
-        r = http_requests.post(
-            f"{PAYPAL_BASE_URL}/v1/billing/subscriptions/{sub_id}/cancel",
-            headers=paypal_headers(),
+        r = paypal_request(
+            "POST",
+            f"{_PP_SUB_URL}/{sub_id}/cancel",
             json={"reason": "Cancellato dall'utente tramite NBA Over Predictor"},
             timeout=10,
         )
         if r.status_code in (200, 204):
-            set_user_free(uid)
-            db = get_admin_db()
-            db.collection("users").document(uid).set(
-                {"paypal_subscription_id": None}, merge=True
-            )
-            print(f"[PayPal] ⬇️ Abbonamento cancellato uid={uid}")
+            set_user_free(uid, extras={"paypal_subscription_id": None})
+            log.info("[PayPal] ⬇️ Abbonamento cancellato uid=%s", uid)
             return jsonify({"success": True})
         return jsonify({"error": f"PayPal ha risposto {r.status_code}: {r.text}"}), 500
     except Exception as e:
-        print(f"[PayPal cancel-subscription] {e}")
+        log.error("[PayPal cancel-subscription] %s", e)
         return jsonify({"error": str(e)}), 500
 
 
+# Eventi webhook accodati: PayPal riceve subito il 200, un solo consumer li raggruppa
+# (fino a 200 eventi o 100 ms) e scrive tutto il gruppo con un unico batch Firestore.
+# Coda limitata: a coda piena la route risponde 503 e PayPal ritenta più tardi
+_WEBHOOK_QUEUE_MAX    = 5_000
+_EVENT_QUEUE          = queue.Queue(maxsize=_WEBHOOK_QUEUE_MAX)
+_WEBHOOK_BATCH_MAX    = 200   # ≤ 2 scritture per evento: resta sotto il limite di 500 per batch
+_WEBHOOK_BATCH_WINDOW = 0.1
+_WEBHOOK_COMMIT_RETRIES = 3   # tentativi di commit (backoff 0.5 s, 1 s) prima di rimettere il gruppo in coda
+
+_PP_EVENTS_SEEN     = OrderedDict()  # id evento PayPal già elaborati (i retry automatici vengono scartati), LRU
+_PP_EVENTS_SEEN_MAX = 2048
+_PP_EVENTS_LOCK     = threading.Lock()
+
+
+def _paypal_event_is_new(event_id: str, mark: bool = True) -> bool:
+    if not event_id:
+        return True
+    with _PP_EVENTS_LOCK:
+        if event_id in _PP_EVENTS_SEEN:
+            _PP_EVENTS_SEEN.move_to_end(event_id)
+            return False
+        if not mark:
+            return True
+        _PP_EVENTS_SEEN[event_id] = True
+        while len(_PP_EVENTS_SEEN) > _PP_EVENTS_SEEN_MAX:
+            _PP_EVENTS_SEEN.popitem(last=False)
+        return True
+
+
 @payments_bp.route("/webhook/paypal", methods=["POST"])
 def paypal_webhook():
     if not PAYPAL_CLIENT_ID:
         return jsonify({"error": "PayPal non configurato"}), 500
-    payload    = request.get_json(force=True)
-    event_type = payload.get("event_type", "")
-    resource   = payload.get("resource", {})
-    print(f"[PayPal Webhook] event={event_type}")
+    # PayPal invia sempre application/json: niente force, e body malformato → None
+    payload    = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Payload non valido"}), 400
+    log.debug("[PayPal Webhook] event=%s", payload.get("event_type", ""))
+
+    # Retry di una trasmissione già verificata: niente seconda verifica firma.
+    # Solo lettura: l'id viene registrato dal worker dopo la firma valida
+    if _webhook_seen("paypal", request.headers.get("PAYPAL-TRANSMISSION-ID", ""), mark=False):
+        log.debug("[PayPal Webhook] Trasmissione duplicata ignorata")
+        return jsonify({"received": True}), 200
+
+    # Gli header servono alla verifica firma: copiati qui, il worker non ha la request
+    signature = {name: request.headers.get(header, "") for name, header in _PP_SIGNATURE_HEADERS.items()}
+    # Controlli locali prima del 200: un post senza firma PayPal non arriva al worker
+    if PAYPAL_WEBHOOK_ID and not _paypal_signature_well_formed(signature):
+        log.warning("[PayPal Webhook] Header firma mancanti o non validi")
+        return jsonify({"error": "Firma mancante o non valida"}), 400
+
+    # Il CRC32 della firma va calcolato sui byte ricevuti, non sul JSON riserializzato
+    body     = request.get_data()
+    verified = False
+    if (
+        PAYPAL_WEBHOOK_ID
+        and CRYPTOGRAPHY_AVAILABLE
+        and signature["auth_algo"] == "SHA256withRSA"
+        and _paypal_cert_cached(signature["cert_url"])
+    ):
+        # Certificato già in cache: verifica RSA inline senza rete; se non passa decide il worker
+        verified = paypal_verify_signature_local(body, signature)
+    try:
+        _EVENT_QUEUE.put_nowait((body, payload, signature, verified))
+    except queue.Full:
+        log.warning("[PayPal Webhook] Coda piena, PayPal ritenterà")
+        return jsonify({"error": "Coda piena, riprova"}), 503
+    return jsonify({"received": True}), 200
+
+
+# Header della firma PayPal, copiati dalla request con questi nomi (gli stessi di verify-webhook-signature)
+_PP_SIGNATURE_HEADERS = {
+    "auth_algo":         "PAYPAL-AUTH-ALGO",
+    "cert_url":          "PAYPAL-CERT-URL",
+    "transmission_id":   "PAYPAL-TRANSMISSION-ID",
+    "transmission_sig":  "PAYPAL-TRANSMISSION-SIG",
+    "transmission_time": "PAYPAL-TRANSMISSION-TIME",
+}
+
+
+def _paypal_signature_well_formed(signature: dict) -> bool:
+    # Tutti gli header presenti, cert servito da PayPal e firma in base64 valido
+    if not all(signature.values()) or not _paypal_cert_url_pinned(signature["cert_url"]):
+        return False
+    try:
+        base64.b64decode(signature["transmission_sig"], validate=True)
+    except ValueError:
+        return False
+    return True
 
-    # Verifica firma
-    if PAYPAL_WEBHOOK_ID:
+
+_PP_CERT_CACHE  = {}    # {cert_url: (chiave pubblica, scadenza certificato epoch)}, solo catene fidate
+_PP_CERT_LOCK   = threading.Lock()
+_PP_TRUST_ROOTS = None  # {subject: [root]} dal bundle certifi, caricato al primo webhook
+
+
+def _trusted_roots() -> dict:
+    global _PP_TRUST_ROOTS
+    if _PP_TRUST_ROOTS is None:
+        with open(certifi.where(), "rb") as f:
+            roots = {}
+            for root in x509.load_pem_x509_certificates(f.read()):
+                roots.setdefault(root.subject, []).append(root)
+        _PP_TRUST_ROOTS = roots
+    return _PP_TRUST_ROOTS
+
+
+def _chain_is_trusted(chain: list) -> bool:
+    # Foglia → intermedi (come serviti da PAYPAL-CERT-URL) → una root CA del bundle certifi
+    now = datetime.now(timezone.utc)
+    if any(not (cert.not_valid_before_utc <= now <= cert.not_valid_after_utc) for cert in chain):
+        return False
+    try:
+        for child, parent in zip(chain, chain[1:]):
+            child.verify_directly_issued_by(parent)
+    except (InvalidSignature, ValueError, TypeError):
+        return False
+    last = chain[-1]
+    for root in _trusted_roots().get(last.issuer, []):
+        if root == last:
+            return True
         try:
-            verify = http_requests.post(
-                f"{PAYPAL_BASE_URL}/v1/notifications/verify-webhook-signature",
-                headers=paypal_headers(),
-                json={
-                    "auth_algo":         request.headers.get("PAYPAL-AUTH-ALGO", ""),
-                    "cert_url":          request.headers.get("PAYPAL-CERT-URL", ""),
-                    "transmission_id":   request.headers.get("PAYPAL-TRANSMISSION-ID", ""),
-                    "transmission_sig":  request.headers.get("PAYPAL-TRANSMISSION-SIG", ""),
-                    "transmission_time": request.headers.get("PAYPAL-TRANSMISSION-TIME", ""),
-                    "webhook_id":        PAYPAL_WEBHOOK_ID,
-                    "webhook_event":     payload,
-                },
-                timeout=10,
-            )
-            if verify.json().get("verification_status") != "SUCCESS":
-                return jsonify({"error": "Firma non valida"}), 400
+            last.verify_directly_issued_by(root)
+            return True
+        except (InvalidSignature, ValueError, TypeError):
+            continue
+    return False
+
+
+def _paypal_cert_url_pinned(cert_url: str) -> bool:
+    # Solo certificati serviti da PayPal in https: altrimenti chiunque potrebbe firmare con il proprio
+    parsed = urlparse(cert_url)
+    host   = parsed.hostname or ""
+    return parsed.scheme == "https" and (host == "paypal.com" or host.endswith(".paypal.com"))
+
+
+def _paypal_cert_cached(cert_url: str):
+    """Chiave pubblica del certificato se già in cache e non scaduto, altrimenti None (nessuna rete)"""
+    with _PP_CERT_LOCK:
+        cached = _PP_CERT_CACHE.get(cert_url)
+    if cached and time.time() < cached[1]:
+        return cached[0]
+    return None
+
+
+def _paypal_cert_key(cert_url: str):
+    if not _paypal_cert_url_pinned(cert_url):
+        return None
+    cached = _paypal_cert_cached(cert_url)
+    if cached is not None:
+        return cached
+    r = _PAYPAL_SESSION.get(cert_url, timeout=10)
+    r.raise_for_status()
+    chain = x509.load_pem_x509_certificates(r.content)
+    if not _chain_is_trusted(chain):
+        return None
+    entry = (chain[0].public_key(), chain[0].not_valid_after_utc.timestamp())
+    with _PP_CERT_LOCK:
+        _PP_CERT_CACHE[cert_url] = entry
+    return entry[0]
+
+
+def paypal_verify_signature_local(body: bytes, signature: dict) -> bool:
+    """Verifica RSA-SHA256 di transmission_id|transmission_time|webhook_id|crc32(body) con il cert PayPal"""
+    # cert_url e header arrivano dal mittente: fetch/parse/verify che falliscono non sono mai un successo
+    try:
+        key = _paypal_cert_key(signature["cert_url"])
+        if key is None:
+            return False
+        expected = f"{signature['transmission_id']}|{signature['transmission_time']}|{PAYPAL_WEBHOOK_ID}|{zlib.crc32(body)}"
+        key.verify(base64.b64decode(signature["transmission_sig"]), expected.encode(), padding.PKCS1v15(), hashes.SHA256())
+        return True
+    except Exception as e:
+        log.warning("[PayPal Webhook] Verifica locale non riuscita: %s", e)
+        return False
+
+
+def paypal_verify_signature_remote(payload: dict, signature: dict) -> bool:
+    verify = paypal_request(
+        "POST",
+        _PP_VERIFY_URL,
+        json={
+            **signature,
+            "webhook_id":        PAYPAL_WEBHOOK_ID,
+            "webhook_event":     payload,
+        },
+        timeout=10,
+    )
+    return _response_json(verify).get("verification_status") == "SUCCESS"
+
+
+def _paypal_signature_valid(body: bytes, payload: dict, signature: dict) -> bool:
+    # Il verdetto locale può solo accettare: se fallisce o solleva decide l'API PayPal,
+    # e un errore dell'API equivale a firma non valida
+    if CRYPTOGRAPHY_AVAILABLE and signature.get("auth_algo") == "SHA256withRSA":
+        try:
+            if paypal_verify_signature_local(body, signature):
+                return True
+        except Exception as e:
+            log.warning("[PayPal Webhook] Verifica locale non riuscita: %s", e)
+    try:
+        return paypal_verify_signature_remote(payload, signature)
+    except Exception as e:
+        log.error("[PayPal Webhook] Errore verifica remota: %s", e)
+        return False
+
+
+def _webhook_consumer():
+    while True:
+        item = _EVENT_QUEUE.get()
+        if item is None:
+            return
+        group    = [item]
+        deadline = time.monotonic() + _WEBHOOK_BATCH_WINDOW
+        stop     = False
+        while len(group) < _WEBHOOK_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _EVENT_QUEUE.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            group.append(item)
+        _process_paypal_events(group)
+        if stop:
+            return
+
+
+def _process_paypal_events(group: list):
+    # Verifica e dedup in sola lettura: gli id vengono registrati solo a commit riuscito,
+    # così un batch perso non fa scartare come duplicati i retry degli stessi eventi
+    accepted = []
+    in_group = set()
+    for body, payload, signature, verified in group:
+        try:
+            if not _paypal_event_accepted(body, payload, signature, verified):
+                continue
         except Exception as e:
-            print(f"[PayPal Webhook] Errore verifica: {e}")
+            log.error("[PayPal Webhook] Errore verifica: %s", e)
+            continue
+        key = (signature.get("transmission_id"), payload.get("id"))
+        if key not in in_group:
+            in_group.add(key)
+            accepted.append((body, payload, signature, True))
+    if not accepted:
+        return
+
+    for attempt in range(_WEBHOOK_COMMIT_RETRIES):
+        if attempt:
+            time.sleep(0.5 * 2 ** (attempt - 1))
+        try:
+            batch  = get_admin_db().batch()
+            staged = 0
+            for _, payload, _, _ in accepted:
+                try:
+                    staged += _handle_paypal_event(payload, batch)
+                except Exception as e:
+                    log.error("[PayPal Webhook] Errore elaborazione: %s", e)
+            if staged:
+                batch.commit()
+                log.info("[PayPal Webhook] batch scritto: %s eventi, %s aggiornamenti", len(accepted), staged)
+        except Exception as e:
+            log.warning("[PayPal Webhook] Commit batch fallito (tentativo %s): %s", attempt + 1, e)
+            continue
+        for _, payload, signature, _ in accepted:
+            _webhook_seen("paypal", signature.get("transmission_id", ""))
+            _paypal_event_is_new(payload.get("id"))
+        return
+
+    # Firestore non raggiungibile: il gruppo (già verificato) torna in coda invece di andare perso
+    requeued = 0
+    for item in accepted:
+        try:
+            _EVENT_QUEUE.put_nowait(item)
+            requeued += 1
+        except queue.Full:
+            break
+    log.error("[PayPal Webhook] Errore commit batch: %s/%s eventi rimessi in coda", requeued, len(accepted))
+
+
+def _paypal_event_accepted(body: bytes, payload: dict, signature: dict, verified: bool = False) -> bool:
+    """Firma valida e evento non ancora scritto (id letti, non registrati)"""
+    # Verifica firma (se la route non l'ha già fatta inline col certificato in cache)
+    if PAYPAL_WEBHOOK_ID and not verified and not _paypal_signature_valid(body, payload, signature):
+        log.warning("[PayPal Webhook] Firma non valida, evento scartato (%s)", payload.get("event_type", ""))
+        return False
+
+    # Dopo la verifica: un evento falsificato non può "bruciare" l'id di uno vero
+    if _webhook_seen("paypal", signature.get("transmission_id", ""), mark=False):
+        log.debug("[PayPal Webhook] Trasmissione duplicata ignorata")
+        return False
+    if not _paypal_event_is_new(payload.get("id"), mark=False):
+        log.debug("[PayPal Webhook] Evento duplicato ignorato id=%s", payload.get("id"))
+        return False
+    return True
+
+
+_WEBHOOK_CONSUMER = threading.Thread(target=_webhook_consumer, name="paypal-webhook", daemon=True)
+_WEBHOOK_CONSUMER.start()
+
+
+def _stop_webhook_consumer():
+    # Gli eventi già confermati a PayPal vanno scritti prima che il worker esca
+    try:
+        _EVENT_QUEUE.put(None, timeout=10)
+    except queue.Full:
+        return
+    _WEBHOOK_CONSUMER.join(timeout=10)
+
+
+atexit.register(_stop_webhook_consumer)
+
+
+def _handle_paypal_event(payload: dict, batch) -> int:
+    """Accoda nel batch gli aggiornamenti di un evento già verificato; ritorna quanti utenti tocca"""
+    event_type = payload.get("event_type", "")
+    resource   = payload.get("resource", {})
 
     if event_type == "BILLING.SUBSCRIPTION.ACTIVATED":
         uid    = resource.get("custom_id")
         sub_id = resource.get("id")
         if uid:
-            set_user_premium(uid)
-            db = get_admin_db()
-            db.collection("users").document(uid).set(
-                {"paypal_subscription_id": sub_id}, merge=True
+            set_user_premium(
+                uid,
+                extras={"paypal_subscription_id": sub_id},
+                index=(PAYPAL_SUBSCRIPTIONS_INDEX, sub_id) if sub_id else None,
+                batch=batch,
             )
-            print(f"[PayPal Webhook] ✅ Premium uid={uid}")
+            log.info("[PayPal Webhook] ✅ Premium uid=%s", uid)
+            return 1
 
     elif event_type in (
         "BILLING.SUBSCRIPTION.CANCELLED",
@@ -429,16 +958,17 @@ def paypal_webhook():
         uid    = resource.get("custom_id")
         sub_id = resource.get("id")
         if uid:
-            set_user_free(uid)
-            print(f"[PayPal Webhook] ⬇️ Free uid={uid} ({event_type})")
+            set_user_free(uid, batch=batch)
+            log.info("[PayPal Webhook] ⬇️ Free uid=%s (%s)", uid, event_type)
+            return 1
         elif sub_id:
+            staged = 0
             try:
-                db = get_admin_db()
-                docs = db.collection("users").where("paypal_subscription_id", "==", sub_id).stream()
-                for doc in docs:
-                    set_user_free(doc.id)
-                    print(f"[PayPal Webhook] ⬇️ Free uid={doc.id} (lookup)")
+                for uid in lookup_uids(PAYPAL_SUBSCRIPTIONS_INDEX, "paypal_subscription_id", sub_id):
+                    set_user_free(uid, batch=batch)
+                    staged += 1
+                    log.info("[PayPal Webhook] ⬇️ Free uid=%s (lookup)", uid)
             except Exception as e:
-                print(f"[PayPal Webhook] Errore lookup: {e}")
-
-    return jsonify({"received": True}), 200
\ No newline at end of file
+                log.error("[PayPal Webhook] Errore lookup: %s", e)
+            return staged
+    return 0
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build_game_log(n: int = 70, seed: int = 5) -> pd.DataFrame:
+    """Game log sintetico con le colonne di Basketball Reference"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n):
+        fga = int(rng.integers(10, 25))
+        fg = int(rng.integers(3, fga))
+        tpa = int(rng.integers(2, 10))
+        tp = min(int(rng.integers(0, tpa)), fg)
+        fta = int(rng.integers(0, 12))
+        ft = int(rng.integers(0, fta + 1))
+        pts = 2 * (fg - tp) + 3 * tp + ft
+        rows.append({
+            "Rk": i + 1,
+            "Date": (pd.Timestamp("2024-10-20") + pd.Timedelta(days=2 * i)).strftime("%Y-%m-%d"),
+            "MP": f"{rng.integers(25, 40)}:{rng.integers(0, 60):02d}",
+            "FG": fg, "FGA": fga, "FG%": round(fg / fga, 3),
+            "3P": tp, "3PA": tpa, "3P%": round(tp / tpa, 3),
+            "2P": fg - tp, "2PA": fga - tpa, "2P%": round((fg - tp) / max(fga - tpa, 1), 3),
+            "FT": ft, "FTA": fta, "FT%": round(ft / fta, 3) if fta else 0,
+            "ORB": int(rng.integers(0, 4)), "DRB": int(rng.integers(2, 9)), "TRB": 0,
+            "AST": int(rng.integers(2, 11)), "STL": int(rng.integers(0, 3)), "BLK": int(rng.integers(0, 3)),
+            "TOV": int(rng.integers(0, 5)), "PF": int(rng.integers(0, 5)), "PTS": pts,
+            "GmSc": round(pts * 0.8, 1), "+/-": int(rng.integers(-15, 15)),
+            "eFG%": round((fg + 0.5 * tp) / fga, 3),
+        })
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def game_log_csv():
+    return build_game_log().to_csv(index=False)
+
+
+@pytest.fixture(autouse=True)
+def _clean_model_cache():
+    import model
+    model.clear_cache()
+    yield
+    model.clear_cache()
@@ -0,0 +1,44 @@
+import threading
+from unittest import mock
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def blocked_fetch():
+    release = threading.Event()
+
+    def fetch(player_id, season_str, player_name):
+        release.wait(10)
+        return "csv", 0
+
+    with mock.patch.object(app, "NBA_API_AVAILABLE", True), \
+         mock.patch.object(app, "get_player_csv", side_effect=fetch), \
+         mock.patch.object(app, "_FETCH_JOBS", app.OrderedDict()), \
+         mock.patch.object(app, "_FETCH_JOBS_INFLIGHT", {}):
+        yield
+        release.set()
+
+
+def test_fetch_async_reuses_inflight_job(client, blocked_fetch):
+    first  = client.post("/fetch_player_csv/async", json={"player_id": 2544, "season": "2026"})
+    second = client.post("/fetch_player_csv/async", json={"player_id": 2544, "season": "2026"})
+
+    assert first.status_code == second.status_code == 202
+    assert first.get_json()["job_id"] == second.get_json()["job_id"]
+
+
+def test_fetch_async_caps_pending_jobs(client, blocked_fetch):
+    for player_id in range(1, app._FETCH_JOBS_MAX_PENDING + 1):
+        assert client.post("/fetch_player_csv/async", json={"player_id": player_id}).status_code == 202
+
+    response = client.post("/fetch_player_csv/async", json={"player_id": 9999})
+
+    assert response.status_code == 429
@@ -0,0 +1,60 @@
+import numpy as np
+
+import model
+
+
+def test_final_over_probabilities_non_increasing(game_log_csv):
+    df = model.parse_player_csv(game_log_csv)
+    pts = df["PTS"].tail(35).to_numpy()
+    lo, hi = np.nanquantile(pts, [0.05, 0.95])
+    thresholds = [float(t) + 0.5 for t in np.arange(np.ceil(lo), np.floor(hi))]
+
+    results = model.final_over_probabilities(df, thresholds, recent_games=35)
+
+    probabilities = [r["probability"] for r in results]
+    assert all(r["method_used"].startswith("ensemble_ml") for r in results)
+    assert all(a >= b for a, b in zip(probabilities, probabilities[1:])), probabilities
+
+
+def _float64_frame(csv_text):
+    # Statistiche float64: to_numpy() restituisce viste read-only (copy-on-write di pandas 3)
+    df = model.parse_player_csv(csv_text).copy()
+    numeric = df.select_dtypes("float32").columns
+    df[numeric] = df[numeric].astype(np.float64)
+    return df
+
+
+def test_final_over_probability_float64_frame(game_log_csv):
+    df = _float64_frame(game_log_csv)
+    assert not df["PTS"].to_numpy().flags.writeable
+
+    result = model.final_over_probability(df, point_line=20.5, recent_games=35)
+
+    assert result["method_used"].startswith("ensemble_ml")
+    assert 0 <= result["probability"] <= 100
+
+
+def test_final_over_probabilities_float64_fallback_paths(game_log_csv):
+    df = _float64_frame(game_log_csv)
+
+    # 6 partite: meno di 8 righe con feature → _weighted_over_kernel sul campione read-only
+    short = model.final_over_probabilities(df, [20.5], recent_games=6)
+    # soglie fuori dai quantili → frequenza empirica
+    extreme = model.final_over_probabilities(df, [0.5, 99.5], recent_games=35)
+
+    assert short[0]["method_used"] == "weighted_empirical"
+    assert [r["method_used"] for r in extreme] == ["extreme_threshold_low", "extreme_threshold_high"]
+    assert [r["probability"] for r in extreme] == [100.0, 0.0]
+
+
+def test_parse_player_csv_ragged_rows(game_log_csv):
+    lines = game_log_csv.splitlines()
+    # Riga Inactive di Basketball Reference: meno campi dell'header
+    lines.insert(3, "3,2024-10-24,Inactive")
+    ragged = "\n".join(lines) + "\n"
+
+    df = model.parse_player_csv(ragged)
+
+    assert len(df) == len(lines) - 1
+    inactive = df[df["MP"].astype(str) == "Inactive"]
+    assert len(inactive) == 1 and np.isnan(inactive["PTS"].iloc[0])
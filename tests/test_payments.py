@@ -0,0 +1,146 @@
+import base64
+import json
+import time
+import zlib
+from unittest import mock
+
+import pytest
+import stripe
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from flask import Flask
+
+import payments
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(payments.payments_bp)
+    # Il pool gira nello stesso thread: gli effetti sono visibili a fine richiesta
+    with mock.patch.object(payments._WEBHOOK_POOL, "submit", side_effect=lambda fn, *args: fn(*args)):
+        yield app.test_client()
+
+
+def _stripe_event(event_id: str, event_type: str, obj: dict) -> stripe.Event:
+    return stripe.Event.construct_from(
+        {"id": event_id, "object": "event", "type": event_type, "data": {"object": obj}}, "sk_test"
+    )
+
+
+def test_stripe_checkout_completed_activates_premium(client):
+    event = _stripe_event("evt_checkout", "checkout.session.completed", {
+        "object": "checkout.session",
+        "metadata": {"uid": "user-1"},
+        "customer": "cus_1",
+        "customer_email": "a@b.it",
+    })
+    with mock.patch.object(payments, "STRIPE_ENABLED", True), \
+         mock.patch.object(payments.stripe.Webhook, "construct_event", return_value=event), \
+         mock.patch.object(payments, "set_user_premium") as premium:
+        response = client.post("/webhook/stripe", data=b"{}", headers={"Stripe-Signature": "t=1,v1=x"})
+
+    assert response.status_code == 200
+    premium.assert_called_once_with(
+        "user-1",
+        extras={"stripe_customer_id": "cus_1", "email": "a@b.it"},
+        index=(payments.STRIPE_CUSTOMERS_INDEX, "cus_1"),
+    )
+
+
+def test_stripe_unhandled_event_is_acked(client):
+    event = _stripe_event("evt_other", "invoice.paid", {"object": "invoice"})
+    with mock.patch.object(payments, "STRIPE_ENABLED", True), \
+         mock.patch.object(payments.stripe.Webhook, "construct_event", return_value=event):
+        response = client.post("/webhook/stripe", data=b"{}", headers={"Stripe-Signature": "t=1,v1=x"})
+
+    assert response.status_code == 200
+
+
+CERT_URL = "https://api.paypal.com/v1/notifications/certs/CERT-1"
+
+
+@pytest.fixture
+def paypal_queue():
+    events = payments.queue.Queue()
+    with mock.patch.object(payments, "PAYPAL_CLIENT_ID", "client"), \
+         mock.patch.object(payments, "PAYPAL_WEBHOOK_ID", "WH-1"), \
+         mock.patch.object(payments, "_EVENT_QUEUE", events):
+        yield events
+
+
+def _paypal_headers(transmission_id: str, **overrides) -> dict:
+    headers = {
+        "PAYPAL-AUTH-ALGO":         "SHA256withRSA",
+        "PAYPAL-CERT-URL":          CERT_URL,
+        "PAYPAL-TRANSMISSION-ID":   transmission_id,
+        "PAYPAL-TRANSMISSION-SIG":  base64.b64encode(b"firma").decode(),
+        "PAYPAL-TRANSMISSION-TIME": "2026-10-14T10:00:00Z",
+    }
+    headers.update(overrides)
+    return {k: v for k, v in headers.items() if v is not None}
+
+
+@pytest.mark.parametrize("overrides", [
+    {"PAYPAL-TRANSMISSION-SIG": None},
+    {"PAYPAL-CERT-URL": "https://evil.example.com/cert.pem"},
+    {"PAYPAL-CERT-URL": "http://api.paypal.com/cert.pem"},
+    {"PAYPAL-TRANSMISSION-SIG": "non base64!"},
+])
+def test_paypal_webhook_rejects_bad_signature_headers(client, paypal_queue, overrides):
+    response = client.post("/webhook/paypal", json={"id": "WH-EVT", "event_type": "X"},
+                           headers=_paypal_headers("T-bad", **overrides))
+
+    assert response.status_code == 400
+    assert paypal_queue.empty()
+
+
+def test_paypal_webhook_verifies_inline_with_cached_cert(client, paypal_queue):
+    key  = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    body = json.dumps({"id": "WH-EVT-2", "event_type": "X"}).encode()
+    sig  = key.sign(f"T-ok|2026-10-14T10:00:00Z|WH-1|{zlib.crc32(body)}".encode(), padding.PKCS1v15(), hashes.SHA256())
+    headers = _paypal_headers("T-ok", **{"PAYPAL-TRANSMISSION-SIG": base64.b64encode(sig).decode()})
+
+    with mock.patch.dict(payments._PP_CERT_CACHE, {CERT_URL: (key.public_key(), time.time() + 3600)}):
+        response = client.post("/webhook/paypal", data=body, content_type="application/json", headers=headers)
+
+    assert response.status_code == 200
+    *_, verified = paypal_queue.get_nowait()
+    assert verified is True
+
+
+def _activation_item(event_id: str, transmission_id: str) -> tuple:
+    payload = {"id": event_id, "event_type": "BILLING.SUBSCRIPTION.ACTIVATED",
+               "resource": {"id": "I-SUB", "custom_id": "user-2"}}
+    return b"{}", payload, {"transmission_id": transmission_id}, True
+
+
+def test_paypal_failed_commit_requeues_without_marking_ids(paypal_queue):
+    db = mock.MagicMock()
+    db.batch.return_value.commit.side_effect = RuntimeError("firestore down")
+    item = _activation_item("WH-EVT-3", "T-3")
+
+    with mock.patch.object(payments, "get_admin_db", return_value=db), \
+         mock.patch.object(payments.time, "sleep"):
+        payments._process_paypal_events([item])
+
+    assert db.batch.return_value.commit.call_count == payments._WEBHOOK_COMMIT_RETRIES
+    assert paypal_queue.get_nowait() == item
+    assert payments._paypal_event_is_new("WH-EVT-3", mark=False)
+    assert not payments._webhook_seen("paypal", "T-3", mark=False)
+
+    db.batch.return_value.commit.side_effect = None
+    with mock.patch.object(payments, "get_admin_db", return_value=db):
+        payments._process_paypal_events([item])
+
+    assert not payments._paypal_event_is_new("WH-EVT-3", mark=False)
+    assert payments._webhook_seen("paypal", "T-3", mark=False)
+
+
+def test_paypal_webhook_full_queue_returns_503(client, paypal_queue):
+    with mock.patch.object(payments, "_EVENT_QUEUE", payments.queue.Queue(maxsize=1)) as full:
+        full.put_nowait(None)
+        response = client.post("/webhook/paypal", json={"id": "WH-EVT-4", "event_type": "X"},
+                               headers=_paypal_headers("T-4"))
+
+    assert response.status_code == 503